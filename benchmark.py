@@ -0,0 +1,330 @@
+import argparse
+import collections
+import csv
+import hashlib
+import json
+import multiprocessing
+import random
+import time
+
+from node.chord import ChordNode, ChordNodeSettings
+from node.request import (send_command, send_command_with_response,
+                          send_lookup_command, send_store_command,
+                          wait_for_convergence)
+
+# Scenarios run in this order on the same ring, lookups read what store wrote
+scenarios = ["store", "lookup", "join", "leave", "churn"]
+# Commands the benchmark itself sends, left out of the message counts
+own_commands = {"stats", "get_routing_state"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Runs Chord benchmarks on localhost and prints JSON lines"
+    )
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 20, 40])
+    parser.add_argument("--successors", type=int, default=5)
+    parser.add_argument("--stabilize", type=float, default=0.5)
+    parser.add_argument("--fix-fingers", type=float, default=0.3)
+    parser.add_argument("--ping", type=float, default=0.2)
+    parser.add_argument("--replication", type=int, default=1)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=scenarios, default=list(scenarios)
+    )
+    parser.add_argument("--ops", type=int, default=500, help="stores and lookups")
+    parser.add_argument("--churn-events", type=int, default=5)
+    parser.add_argument(
+        "--kill", action="store_true", help="churn kills nodes instead of leaving"
+    )
+    parser.add_argument("--dataset", help="csv with Name, Awards and Institution")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-port", type=int, default=None)
+    parser.add_argument("--output", default="benchmarks/results.jsonl")
+    return parser.parse_args()
+
+
+def chord_key(text):
+    return int(hashlib.md5(text.encode()).hexdigest(), 16)
+
+
+# [chord_key, data_key, value] items, from the dataset or generated
+def load_items(args, rng):
+    if args.dataset is None:
+        return [
+            [chord_key(f"institution {rng.randrange(args.ops)}"), str(i % 50), f"{i}"]
+            for i in range(args.ops)
+        ]
+    items = []
+    with open(args.dataset, newline="") as file:
+        for row in csv.DictReader(file):
+            awards = row["Awards"] if row["Awards"] not in ("", "NaN") else "nan"
+            items.append([chord_key(row["Institution"]), awards, row["Name"]])
+    rng.shuffle(items)
+    return items[: args.ops]
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if len(latencies) == 0:
+        return {}
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    return {
+        "mean_ms": sum(latencies) * 1000 / len(latencies),
+        "p50_ms": percentile(0.5) * 1000,
+        "p90_ms": percentile(0.9) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+class Ring:
+    def __init__(self, args, base_port):
+        self.args = args
+        self.base_port = base_port
+        self.next_port = base_port
+        self.processes = {}
+
+    def settings(self):
+        return ChordNodeSettings(
+            self.args.successors,
+            self.args.stabilize,
+            self.args.fix_fingers,
+            self.args.ping,
+            replication_factor=self.args.replication,
+        )
+
+    def nodes(self):
+        return [("localhost", port) for port in self.processes]
+
+    def add_node(self):
+        port = self.next_port
+        self.next_port += 1
+        node = ChordNode(host="localhost", port=port, settings=self.settings())
+        process = multiprocessing.Process(target=node.start_node)
+        process.start()
+        self.processes[port] = process
+        time.sleep(0.1)
+        if port == self.base_port:
+            send_command("initialize_network", "localhost", port)
+        else:
+            send_command_with_response(
+                "join", "localhost", port, "localhost", self.base_port
+            )
+        return port
+
+    def remove_node(self, port, kill=False):
+        send_command_with_response("kill" if kill else "leave", "localhost", port)
+        process = self.processes.pop(port)
+        process.join()
+
+    def wait(self):
+        return wait_for_convergence(
+            self.nodes(), self.args.successors, self.args.timeout
+        )
+
+    # Metrics of every node since the previous call
+    def stats(self):
+        return [
+            send_command_with_response("stats", host, port, "reset")
+            for host, port in self.nodes()
+        ]
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+            process.join()
+        self.processes = {}
+
+
+# Requests every node served by command, maintenance included
+def messages_by_command(stats):
+    messages = collections.Counter()
+    for node_stats in stats:
+        for command, latency in node_stats["server"]["latencies"].items():
+            if command not in own_commands:
+                messages[command] += latency["count"]
+    return dict(messages)
+
+
+def messages(stats):
+    return sum(messages_by_command(stats).values())
+
+
+# Forwarded stores are counted again by their owner with 0 hops, so the total
+# is divided by the operations and not by the observations
+def mean_hops(stats, name, ops):
+    total = 0
+    for node_stats in stats:
+        for hops, times in node_stats["server"]["values"].get(name, {}).items():
+            total += int(hops) * times
+    return total / max(1, ops)
+
+
+# Every request the ring served during the operations, replication, lease
+# invalidations and retries included, along with the maintenance running
+# meanwhile
+def operation_messages(stats, ops):
+    by_command = messages_by_command(stats)
+    total = sum(by_command.values())
+    return {
+        "messages": total,
+        "messages_per_op": total / max(1, ops),
+        "messages_by_command": by_command,
+    }
+
+
+def run_store(ring, items, rng):
+    ring.stats()
+    latencies = []
+    for key, data_key, value in items:
+        host, port = rng.choice(ring.nodes())
+        start = time.perf_counter()
+        send_store_command(host, port, key, data_key, value)
+        latencies.append(time.perf_counter() - start)
+    stats = ring.stats()
+    return {
+        "ops": len(items),
+        "hops": mean_hops(stats, "store_hops", len(items)),
+    } | operation_messages(stats, len(items)) | percentiles(latencies)
+
+
+def lookup_items(ring, items, rng):
+    latencies = []
+    found = 0
+    for key, data_key, value in items:
+        host, port = rng.choice(ring.nodes())
+        start = time.perf_counter()
+        try:
+            result = send_lookup_command(host, port, key, data_key)
+        except Exception:
+            continue
+        latencies.append(time.perf_counter() - start)
+        found += value in result
+    return latencies, found
+
+
+def run_lookup(ring, items, rng):
+    ring.stats()
+    latencies, found = lookup_items(ring, items, rng)
+    stats = ring.stats()
+    return {
+        "ops": len(items),
+        "success_rate": found / max(1, len(items)),
+        "hops": mean_hops(stats, "lookup_hops", len(items)),
+    } | operation_messages(stats, len(items)) | percentiles(latencies)
+
+
+def run_join(ring, items, rng):
+    ring.stats()
+    start = time.monotonic()
+    ring.add_node()
+    converge = ring.wait()
+    return {
+        "time_to_converge_s": converge,
+        "duration_s": time.monotonic() - start,
+        "messages": messages(ring.stats()),
+    }
+
+
+def run_leave(ring, items, rng):
+    ring.stats()
+    port = rng.choice([port for port in ring.processes if port != ring.base_port])
+    start = time.monotonic()
+    ring.remove_node(port)
+    converge = ring.wait()
+    return {
+        "time_to_converge_s": converge,
+        "duration_s": time.monotonic() - start,
+        "messages": messages(ring.stats()),
+    }
+
+
+# Nodes leave (or die) and new ones join one after the other while every
+# stored item is looked up after each change
+def run_churn(ring, items, rng):
+    ring.stats()
+    start = time.monotonic()
+    latencies, found = [], 0
+    for _ in range(ring.args.churn_events):
+        port = rng.choice([port for port in ring.processes if port != ring.base_port])
+        ring.remove_node(port, ring.args.kill)
+        ring.add_node()
+        event_latencies, event_found = lookup_items(ring, items, rng)
+        latencies += event_latencies
+        found += event_found
+    lookups = ring.args.churn_events * len(items)
+    converge = ring.wait()
+    return {
+        "events": ring.args.churn_events,
+        "ops": lookups,
+        "success_rate": found / max(1, lookups),
+        "time_to_converge_s": converge,
+        "duration_s": time.monotonic() - start,
+        "messages": messages(ring.stats()),
+    } | percentiles(latencies)
+
+
+runners = {
+    "store": run_store,
+    "lookup": run_lookup,
+    "join": run_join,
+    "leave": run_leave,
+    "churn": run_churn,
+}
+
+
+def run(args, num_nodes, base_port, output):
+    rng = random.Random(f"{args.seed}:{num_nodes}")
+    items = load_items(args, rng)
+    ring = Ring(args, base_port)
+    try:
+        start = time.monotonic()
+        for _ in range(num_nodes):
+            ring.add_node()
+        converge = ring.wait()
+        results = [
+            {
+                "scenario": "startup",
+                "time_to_converge_s": converge,
+                "duration_s": time.monotonic() - start,
+            }
+        ]
+        for scenario in scenarios:
+            if scenario in args.scenarios:
+                result = runners[scenario](ring, items, rng)
+                results.append({"scenario": scenario} | result)
+        for result in results:
+            line = json.dumps(
+                {
+                    "nodes": num_nodes,
+                    "successors": args.successors,
+                    "stabilize": args.stabilize,
+                    "fix_fingers": args.fix_fingers,
+                    "ping": args.ping,
+                    "replication": args.replication,
+                    "seed": args.seed,
+                }
+                | result
+            )
+            print(line, flush=True)
+            if output is not None:
+                output.write(line + "\n")
+                output.flush()
+    finally:
+        ring.stop()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    base_port = args.base_port or random.randint(8000, 10000)
+    output = open(args.output, "a") if args.output else None
+    for num_nodes in args.nodes:
+        run(args, num_nodes, base_port, output)
+        # Fresh ports, the old ones may still linger in TIME_WAIT
+        base_port += num_nodes + args.churn_events + 1
+    if output is not None:
+        output.close()
@@ -1,14 +1,26 @@
+import bisect
+import collections
 import hashlib
-import pickle
+import os
 import random
-import socket
 import threading
 import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-from node.node import P2PNode
-from node.request import (send_command, send_command_async,
-                          send_command_with_response, send_store_command,
-                          send_transfer_receive_command)
+from node.node import NodeInfo, P2PNode
+from node.metrics import Metrics
+from node.protocol import (RemoteError, decode, encode, header, recv_frame,
+                           send_message)
+from node.request import (client_metrics, failure_detector, send_command,
+                          send_command_with_response,
+                          send_direct_lookup_command,
+                          send_direct_store_command,
+                          send_forward_lookup_command,
+                          send_heartbeat_command, send_lookup_many_command,
+                          send_store_command, send_store_many_command)
+from node.storage import BloomFilter, LogStorage, SortedStorage
 
 
 class ChordNodeSettings:
@@ -18,31 +30,348 @@ class ChordNodeSettings:
         stabilize_interval,
         fix_fingers_interval,
         ping_successors_interval,
+        server_threads=16,
+        finger_refresh_interval=5.0,
+        transfer_chunk_size=256 * 1024,
+        compress_transfers=True,
+        storage_directory=None,
+        location_cache_size=1024,
+        location_cache_ttl=30.0,
+        replication_factor=1,
+        read_from_replicas=False,
+        bloom_filter_bits=0,
+        bloom_filter_hashes=7,
+        maintenance_threads=True,
+        clock=time.monotonic,
+        virtual_nodes=1,
+        hot_key_threshold=50,
+        hot_key_ttl=2.0,
+        value_cache_size=1024,
     ):
         self.size_successor_list = size_successor_list
         self.stabilize_interval = stabilize_interval
         self.fix_fingers_interval = fix_fingers_interval
+        # Neighbors we haven't heard from for this long get a heartbeat
         self.ping_successors_interval = ping_successors_interval
+        self.server_threads = server_threads
+        # Fingers are refreshed on membership changes, at most every
+        # fix_fingers_interval, and otherwise every finger_refresh_interval
+        self.finger_refresh_interval = finger_refresh_interval
+        # Key handoffs are streamed in chunks of about this many bytes
+        self.transfer_chunk_size = transfer_chunk_size
+        self.compress_transfers = compress_transfers
+        # Keep node data on disk under this directory, in memory if None
+        self.storage_directory = storage_directory
+        # Owners of recently routed keys, a size of 0 disables the cache
+        self.location_cache_size = location_cache_size
+        self.location_cache_ttl = location_cache_ttl
+        # Every key is kept on its owner and the next replication_factor - 1
+        # nodes of its successor list, which may serve lookups if enabled
+        self.replication_factor = replication_factor
+        self.read_from_replicas = read_from_replicas
+        # Filter over the owned keys that answers most misses, 0 bits disables
+        # it. It only pays off for storage engines where a miss costs more than
+        # hashing the key, 2**20 bits is a good size then. Nodes share the same
+        # parameters so handoffs can ship their filter
+        self.bloom_filter_bits = bloom_filter_bits
+        self.bloom_filter_hashes = bloom_filter_hashes
+        # Without maintenance threads whoever hosts the node drives it by
+        # calling its *_round methods, like the simulator does on its own clock
+        self.maintenance_threads = maintenance_threads
+        self.clock = clock
+        # Ring positions of a node hosted by a NodeHost, each a ChordNode on the
+        # next port. Nodes with more capacity get more of them so that keys and
+        # requests spread by capacity instead of by the length of a single arc
+        self.virtual_nodes = virtual_nodes
+        # Owners lease the values of keys read hot_key_threshold times within a
+        # second to the nodes routing reads to them, which answer the following
+        # reads for up to hot_key_ttl seconds. A threshold of 0 disables it
+        self.hot_key_threshold = hot_key_threshold
+        self.hot_key_ttl = hot_key_ttl
+        self.value_cache_size = value_cache_size
 
 
-class NodeInfo:
-    def __init__(self, id, host, port):
-        self.id = id
-        self.host = host
-        self.port = port
+# Distinct finger nodes kept in a sorted array of their distance from the owner
+# on the ring. Finger i is the first known node at or after start(i) and the
+# closest preceding finger of an id is found with a single bisect
+class FingerTable:
+    def __init__(self, node):
+        self.node = node
+        self.size = P2PNode.hash_size
+        self.__offsets = []
+        self.__nodes = []
 
-    def __str__(self):
-        return f"id: {self.id}, host {self.host}, port {self.port}"
+    def start(self, i):
+        return (self.node.id + 2**i) % P2PNode.hash_max_num
 
+    def get(self, i):
+        index = bisect.bisect_left(self.__offsets, 2**i)
+        if index == len(self.__offsets):
+            return self.node
+        return self.__nodes[index]
 
-class FingerEntry:
-    def __init__(self, start, interval, id, host, port):
-        self.start = start
-        self.interval = interval
-        self.node = NodeInfo(id, host, port)
+    # Sets finger i to the node found as successor of start(i), any known node
+    # between start(i) and that node can't be alive anymore
+    def update(self, i, node):
+        offset = self.__offset(node.id)
+        low = bisect.bisect_left(self.__offsets, 2**i)
+        if offset == 0:
+            high = len(self.__offsets)
+        else:
+            high = bisect.bisect_left(self.__offsets, offset)
+        if low < high:
+            del self.__offsets[low:high]
+            del self.__nodes[low:high]
+        if offset != 0:
+            self.add(node)
+
+    def add(self, node):
+        offset = self.__offset(node.id)
+        if offset == 0:
+            return
+        index = bisect.bisect_left(self.__offsets, offset)
+        if index < len(self.__offsets) and self.__offsets[index] == offset:
+            self.__nodes[index] = node
+        else:
+            self.__offsets.insert(index, offset)
+            self.__nodes.insert(index, node)
+
+    def nodes(self):
+        return list(self.__nodes)
+
+    def remove(self, id):
+        offset = self.__offset(id)
+        index = bisect.bisect_left(self.__offsets, offset)
+        if index < len(self.__offsets) and self.__offsets[index] == offset:
+            del self.__offsets[index]
+            del self.__nodes[index]
+
+    def reset(self):
+        self.__offsets = []
+        self.__nodes = []
+
+    # First finger of every run of consecutive fingers that share a node, the
+    # rest of the run starts before that node and resolves to it as well
+    def leaders(self):
+        indices = []
+        i = 0
+        while i < self.size:
+            indices.append(i)
+            offset = self.__offset(self.get(i).id) or P2PNode.hash_max_num
+            i = offset.bit_length()
+        return indices
+
+    def closest_preceeding(self, id):
+        # node.id in (self.id, id)
+        index = bisect.bisect_left(self.__offsets, self.__offset(id)) - 1
+        if index < 0:
+            return self.node
+        return self.__nodes[index]
+
+    def entry_str(self, i):
+        interval = range(self.start(i), self.start(i + 1))
+        return f"start: {self.start(i)}, interval {interval}, node {self.get(i)}"
+
+    def __offset(self, id):
+        return (id - self.node.id) % P2PNode.hash_max_num
+
+
+# Recently resolved key ranges (owner, successor], the node owning each and the
+# replicas of its keys when known.
+# Ranges are kept sorted by their distance from the node on the ring so the
+# range of a key is found with a single bisect. The least recently used range
+# is dropped once the cache is full and ranges expire after ttl seconds
+class LocationCache:
+    def __init__(self, node, capacity, ttl, clock=time.monotonic):
+        self.node = node
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.__starts = []
+        self.__ranges = []
+        self.__recent = collections.OrderedDict()  # Owner id to range start
+        self.__lock = threading.Lock()
+
+    # Returns the cached (owner, successor, replicas) of id or None
+    def get(self, id):
+        offset = self.__offset(id)
+        with self.__lock:
+            index = bisect.bisect_right(self.__starts, offset) - 1
+            if index < 0:
+                return None
+            end, owner, successor, replicas, expiry = self.__ranges[index]
+            if offset > end:
+                return None
+            if self.clock() >= expiry:
+                self.__remove_at(index)
+                return None
+            self.__recent.move_to_end(owner.id)
+            return owner, successor, replicas
+
+    # Without replicas the ones already known for the owner are kept
+    def put(self, owner, successor, replicas=None):
+        if self.capacity <= 0 or owner.id == self.node.id:
+            return
+        start = self.__offset(owner.id + 1)
+        end = self.__offset(successor.id) or P2PNode.hash_max_num
+        if end < start:  # Stale range that wraps around this node
+            return
+        with self.__lock:
+            if replicas is None:
+                replicas = []
+                known = self.__recent.get(owner.id)
+                if known is not None:
+                    index = bisect.bisect_left(self.__starts, known)
+                    if self.__ranges[index][2].id == successor.id:
+                        replicas = self.__ranges[index][3]
+            self.__invalidate(owner.id)
+            # Overlapping ranges were resolved before the ring changed
+            index = bisect.bisect_right(self.__starts, end) - 1
+            while index >= 0 and self.__ranges[index][0] >= start:
+                self.__remove_at(index)
+                index -= 1
+            index = bisect.bisect_left(self.__starts, start)
+            self.__starts.insert(index, start)
+            self.__ranges.insert(
+                index, (end, owner, successor, replicas, self.clock() + self.ttl)
+            )
+            self.__recent[owner.id] = start
+            while len(self.__recent) > self.capacity:
+                _, start = self.__recent.popitem(last=False)
+                index = bisect.bisect_left(self.__starts, start)
+                del self.__starts[index]
+                del self.__ranges[index]
+
+    def invalidate(self, id):
+        with self.__lock:
+            self.__invalidate(id)
 
-    def __str__(self):
-        return f"start: {self.start}, interval {self.interval}, node {self.node}"
+    def __invalidate(self, id):
+        start = self.__recent.get(id)
+        if start is not None:
+            self.__remove_at(bisect.bisect_left(self.__starts, start))
+
+    def __remove_at(self, index):
+        del self.__recent[self.__ranges[index][1].id]
+        del self.__starts[index]
+        del self.__ranges[index]
+
+    def __offset(self, id):
+        return (id - self.node.id) % P2PNode.hash_max_num
+
+
+# Read rates of the (chord_key, data_key) pairs a node owns and the leases of
+# the hot ones. A pair is hot once it was read threshold times within a second
+# and stays hot while copies of it are leased. Every lease carries the version
+# of the node's writes it was granted at, a write to a leased pair returns the
+# holders whose copies are still live so that the owner can invalidate them
+class HotKeys:
+    def __init__(self, threshold, ttl, clock=time.monotonic):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.clock = clock
+        self.__window_start = clock()
+        self.__reads = {}
+        self.__leases = {}  # Pair to {(host, port): expiry}
+        self.__version = 0
+        self.__lock = threading.Lock()
+
+    # Counts a read of key and returns the version leased to holder, or None
+    # if the key isn't hot or there is nobody to lease it to
+    def read(self, key, holder=None):
+        if self.threshold <= 0:
+            return None
+        with self.__lock:
+            now = self.clock()
+            if now - self.__window_start >= 1.0:
+                self.__window_start = now
+                self.__reads = {}
+                self.__drop_expired(now)
+            reads = self.__reads[key] = self.__reads.get(key, 0) + 1
+            if holder is None or (reads < self.threshold and key not in self.__leases):
+                return None
+            self.__leases.setdefault(key, {})[holder] = now + self.ttl
+            return self.__version
+
+    # Returns [key, version, holders] of the leased keys written to
+    def write(self, keys):
+        with self.__lock:
+            if len(self.__leases) == 0:
+                return []
+            return self.__release([key for key in keys if key in self.__leases])
+
+    # Returns [key, version, holders] of the leased keys matching, for keys
+    # that moved to another owner
+    def release(self, match):
+        with self.__lock:
+            return self.__release([key for key in self.__leases if match(key)])
+
+    def __release(self, keys):
+        if len(keys) == 0:
+            return []
+        self.__version += 1
+        now = self.clock()
+        released = []
+        for key in set(keys):
+            holders = self.__leases.pop(key)
+            live = [holder for holder, expiry in holders.items() if expiry > now]
+            if len(live) > 0:
+                released.append([key, self.__version, live])
+        return released
+
+    def __drop_expired(self, now):
+        for key, holders in list(self.__leases.items()):
+            if all(expiry <= now for expiry in holders.values()):
+                del self.__leases[key]
+
+
+# Values of hot keys leased by their owners, by (chord_key, data_key), along
+# with the route to the owner. Copies are handed out so that callers never
+# share the cached lists. Invalidations leave a tombstone behind until the
+# leases it cancelled run out, so a lease granted before the write but
+# arriving after its invalidation is refused
+class ValueCache:
+    def __init__(self, capacity, ttl, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.__entries = collections.OrderedDict()  # (version, expiry, values, route)
+        self.__lock = threading.Lock()
+
+    # Returns (values, route) or None
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[2] is None:
+                return None
+            if self.clock() >= entry[1]:
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return list(entry[2]), entry[3]
+
+    # The lease started when the request was sent, the owner's copy of it
+    # never outlives ours
+    def put(self, key, version, requested, values, route):
+        if self.capacity <= 0:
+            return
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] > version and self.clock() < entry[1]:
+                return
+            self.__set(key, (version, requested + self.ttl, list(values), route))
+
+    def invalidate(self, key, version):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] <= version:
+                self.__set(key, (version, self.clock() + self.ttl, None, None))
+
+    def __set(self, key, entry):
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.capacity:
+            self.__entries.popitem(last=False)
 
 
 class ChordNode(P2PNode):
@@ -51,352 +380,695 @@ class ChordNode(P2PNode):
         host,
         port,
         settings,
+        siblings=(),
     ):
-        super().__init__(host, port)
-        self.__predecessor = NodeInfo(self.id, self.host, self.port)
-        self.__finger_table = []
-        i = 1
-        for i in range(1, P2PNode.hash_size + 1):  # 16*8 because MD5 has is 16 bytes
-            self.__finger_table.append(
-                FingerEntry(
-                    start=(self.id + (2 ** (i - 1))) % P2PNode.hash_max_num,
-                    interval=range(
-                        (self.id + (2 ** (i - 1))) % P2PNode.hash_max_num,
-                        (self.id + (2 ** (i))) % P2PNode.hash_max_num,
-                    ),
-                    id=self.id,
-                    host=self.host,
-                    port=self.port,
-                )
+        storage = None
+        if settings.storage_directory is not None:
+            storage = LogStorage(
+                os.path.join(settings.storage_directory, f"{host}_{port}")
+            )
+        key_filter = None
+        if settings.bloom_filter_bits > 0:
+            key_filter = BloomFilter(
+                settings.bloom_filter_bits, settings.bloom_filter_hashes
             )
+        super().__init__(host, port, settings.server_threads, storage, key_filter)
+        # Guards the predecessor, finger table and successor list, which are
+        # shared between the server workers and the maintenance threads
+        self.__lock = threading.RLock()
+        self.__predecessor = NodeInfo(self.id, self.host, self.port)
+        self.__finger_table = FingerTable(NodeInfo(self.id, self.host, self.port))
+        self.__location_cache = LocationCache(
+            NodeInfo(self.id, self.host, self.port),
+            settings.location_cache_size,
+            settings.location_cache_ttl,
+            settings.clock,
+        )
+        self.__hot_keys = HotKeys(
+            settings.hot_key_threshold, settings.hot_key_ttl, settings.clock
+        )
+        self.__value_cache = ValueCache(
+            settings.value_cache_size, settings.hot_key_ttl, settings.clock
+        )
         self.__successor_list = []
         for i in range(settings.size_successor_list):
             self.__successor_list.append(NodeInfo(self.id, self.host, self.port))
         self.__stabilize_interval = settings.stabilize_interval
         self.__fix_fingers_interval = settings.fix_fingers_interval
-        self.__ping_successors_interval = settings.ping_successors_interval
+        self.__finger_refresh_interval = settings.finger_refresh_interval
+        self.__fix_fingers_event = threading.Event()
+        self.__clock = settings.clock
+        self.__last_sweep = settings.clock()
+        self.__transfer_chunk_size = settings.transfer_chunk_size
+        self.__compress_transfers = settings.compress_transfers
+        # Chunks of key handoffs that haven't been committed yet, by transfer id
+        self.__incoming_transfers = {}
+        self.__committed_transfers = collections.OrderedDict()
+        # Copies of the keys of the nodes preceding us, guarded by data_lock
+        # like the data. Replicas are kept in memory, one storage per owner so
+        # that an owner replacing its copy never touches the keys of another
+        self.__replication_factor = settings.replication_factor
+        # Addresses of the other virtual nodes of our physical node, they fail
+        # together with us so they never hold our replicas
+        self.__siblings = set(siblings)
+        self.__read_from_replicas = settings.read_from_replicas
+        self.__replicas = {}
+        self.__replica_ranges = {}
+        # Successor and replicas our range was last copied to, the version
+        # counts our writes so that writes racing a copy trigger another one
+        self.__replicated_state = None
+        self.__replicated_nodes = []
+        self.__replica_version = 0
+        self.__heartbeat_interval = settings.ping_successors_interval
+        self.__maintenance_threads = settings.maintenance_threads
         self.__stabilize_thread = threading.Thread(target=self.__stabilize)
         self.__fix_fingers_thread = threading.Thread(target=self.__fix_fingers)
-        self.__ping_successors_thread = threading.Thread(target=self.__ping_successors)
+        self.__heartbeat_thread = threading.Thread(target=self.__heartbeat)
         self.__active = True
+        # Set while the node hands its keys over before leaving
+        self.__leaving = False
+        # Commands served, hops and maintenance rounds, see the stats command
+        self.metrics = Metrics()
+        # A node that hasn't joined a ring yet believes to own every key, it
+        # must not claim any for other nodes until then
+        self.__in_ring = False
 
-    def handle_commands(self, peer_connection):
-        while True:
-            command = peer_connection.recv(1024).decode("utf-8").split()
-            try:
-                match command[0]:
-                    case "leave":
-                        # Add communication to successor and __predecessor
-                        # Inform requester
-                        self.__active = False
-                        self.__stabilize_thread.join()
-                        self.__fix_fingers_thread.join()
-                        self.__ping_successors_thread.join()
-                        self.__leave()
-                        peer_connection.send("done".encode("utf-8"))
-                        peer_connection.close()
-                        return "close"
-                    case "kill":
-                        # Add communication to successor and __predecessor
-                        # Inform requester
-                        self.__active = False
-                        self.__stabilize_thread.join()
-                        self.__fix_fingers_thread.join()
-                        self.__ping_successors_thread.join()
-                        peer_connection.send("done".encode("utf-8"))
-                        peer_connection.close()
-                        return "close"
-                    case "print":
-                        print(command[1])
-                        peer_connection.send("done".encode("utf-8"))
-                    case "ping":
-                        peer_connection.send("done".encode("utf-8"))
-                    case "find_successor":
-                        peer_connection.send(
-                            pickle.dumps(self.__find_successor(int(command[1])))
-                        )
-                    case "find_predecessor":
-                        predecessor = self.__find_predecessor(int(command[1]))
-                        peer_connection.sendall(pickle.dumps(predecessor))
-                    case "closest_preceeding_finger":
-                        node = self.__closest_preceeding_finger(int(command[1]))
-                        peer_connection.sendall(pickle.dumps(node))
-                    case "get_your_successor":
-                        peer_connection.sendall(pickle.dumps(self.__successor_list[0]))
-                    case "get_your_predecessor":
-                        peer_connection.sendall(pickle.dumps(self.__predecessor))
-                    case "initialize_network":
-                        self.__initialize_network()
-                        peer_connection.send("done".encode("utf-8"))
-                    case "join":
-                        self.__join(command[1], int(command[2]))
-                        peer_connection.send("done".encode("utf-8"))
-                    case "notify":
-                        self.__notify(int(command[1]), str(command[2]), int(command[3]))
-                        peer_connection.send("done".encode("utf-8"))
-                    case "close":
-                        peer_connection.send("close".encode("utf-8"))
-                        peer_connection.close()
-                        return "continue"
-                    case "store":
-                        peer_connection.send("send".encode("utf-8"))
-                        chord_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        data_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        data = pickle.loads(peer_connection.recv(10240))
-                        self.__store(chord_key, data_key, data)
-                        peer_connection.send("close".encode("utf-8"))
-                    case "transfer_receive":
-                        peer_connection.send("send".encode("utf-8"))
-                        chord_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        data_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        data = pickle.loads(peer_connection.recv(10240))
-                        self.__transfer_receive(chord_key, data_key, data)
-                        peer_connection.send("close".encode("utf-8"))
-                    case "lookup":
-                        peer_connection.send("send".encode("utf-8"))
-                        chord_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        data_key = pickle.loads(peer_connection.recv(1024))
-                        peer_connection.send("send".encode("utf-8"))
-                        result = self.__lookup(int(chord_key), str(data_key))
-                        peer_connection.sendall(pickle.dumps(result))
-                    case "propagate_lookup":
-                        peer_connection.send("done".encode("utf-8"))
-                        self.__propagate_lookup(int(command[1]), str(command[2]), str(command[3]), int(command[4]))
-                        peer_connection.close()
-                        return "continue"
-                    # For debugging
-                    case "get_self":
-                        print(NodeInfo(self.id, self.host, self.port))
-                        peer_connection.send("done".encode("utf-8"))
-                    case "get_finger_table":
-                        if len(command) > 1:
-                            print(self.__finger_table[int(command[1])])
-                        else:
-                            for entry in self.__finger_table:
-                                print(entry)
-                        peer_connection.send("done".encode("utf-8"))
-                    case "get_successor_list":
-                        if len(command) > 1:
-                            print(self.__successor_list[int(command[1])])
-                        else:
-                            for entry in self.__successor_list:
-                                print(entry)
-                        peer_connection.send("done".encode("utf-8"))
-                    case "get_predecessor":
-                        print(self.__predecessor)
-                        peer_connection.send("done".encode("utf-8"))
-                    case "get_data":
-                        if len(self.data) > 0:
-                            for chord_key in self.data.keys():
-                                for data_key in self.data[chord_key]:
-                                    print(f"Chord key: {chord_key}, Data Key: {data_key}, Data: {self.data[chord_key][data_key]}")
-                        else:
-                            print("Node has no data")
-                        peer_connection.send("done".encode("utf-8"))
-                    case _:
-                        peer_connection.send("invalid".encode("utf-8"))
-            except Exception:
-                pass
+    def handle_command(self, peer_connection):
+        try:
+            frame = recv_frame(peer_connection)
+        except Exception:  # Peer closed the connection
+            peer_connection.close()
+            return "continue"
+        start = time.perf_counter()
+        request = decode(frame)
+        command = request[0]
+        response = self.execute_request(request)
+        sent = send_message(peer_connection, response)
+        self.metrics.record_rpc(
+            command,
+            time.perf_counter() - start,
+            header.size + len(frame),
+            sent,
+            response[0],
+        )
+        if command in ("leave", "kill"):
+            peer_connection.close()
+            return "close"
+        return "keep"
 
-    def __find_successor(self, id: int):
-        n = self.__find_predecessor(id)
-        # If you are not the successor
-        while True:
-            try:
-                if n.id != self.id:
-                    successor = send_command_with_response(
-                        f"get_your_successor {id}", n.host, n.port
+    # Runs a [command, *args] request and returns its [ok, result] response
+    def execute_request(self, request):
+        try:
+            return [True, self.execute_command(request[0], request[1:])]
+        except Exception as e:
+            return [False, f"{type(e).__name__}: {e}"]
+
+    def execute_command(self, command, args):
+        # Peers must not route through a leaving node or hand keys back to it,
+        # they would be gone with it
+        if self.__leaving and command != "stats":
+            raise RuntimeError("Node is leaving the ring")
+        match command:
+            case "leave":
+                # Add communication to successor and __predecessor
+                # Inform requester
+                self.__stop_maintenance()
+                self.__leaving = True
+                self.__leave()
+                return "done"
+            case "kill":
+                # Add communication to successor and __predecessor
+                # Inform requester
+                self.__stop_maintenance()
+                return "done"
+            case "print":
+                print(args[0])
+                return "done"
+            case "ping":
+                return "done"
+            case "heartbeat":
+                with self.__lock:
+                    return [self.__predecessor, list(self.__successor_list)]
+            case "stats":
+                return self.__stats(len(args) > 0 and args[0] == "reset")
+            case "find_successor":
+                return self.__find_successor(int(args[0]))
+            case "find_predecessor":
+                return self.__find_predecessor(int(args[0]))
+            case "closest_preceeding_finger":
+                return self.__closest_preceeding_finger(int(args[0]))
+            case "route_step":
+                if not self.__in_ring:
+                    raise RuntimeError("Node isn't part of a ring yet")
+                return self.__route_step(int(args[0]))
+            case "get_your_successor":
+                return self.__successor_list[0]
+            case "get_your_predecessor":
+                return self.__predecessor
+            case "get_routing_state":
+                with self.__lock:
+                    return [
+                        self.__predecessor,
+                        list(self.__successor_list),
+                        self.__finger_table.nodes(),
+                    ]
+            case "initialize_network":
+                self.__initialize_network()
+                return "done"
+            case "join":
+                self.__join(str(args[0]), int(args[1]))
+                return "done"
+            case "notify":
+                self.__notify(int(args[0]), str(args[1]), int(args[2]))
+                return "done"
+            case "store":
+                self.__store(int(args[0]), str(args[1]), args[2])
+                return "done"
+            case "store_many":
+                self.__store_many(args[0], int(args[1]) if len(args) > 1 else 0)
+                return "done"
+            case "transfer_begin":
+                return self.__transfer_begin(str(args[0]))
+            case "transfer_chunk":
+                self.__transfer_chunk(str(args[0]), int(args[1]), bool(args[2]), args[3])
+                return "done"
+            case "transfer_commit":
+                self.__transfer_commit(
+                    str(args[0]),
+                    int(args[1]),
+                    args[2] if len(args) > 2 else None,
+                    args[3] if len(args) > 3 else None,
+                )
+                return "done"
+            case "replicate":
+                self.__replicate_store(int(args[0]), args[1])
+                return "done"
+            case "replica_drop":
+                self.__replica_drop(int(args[0]))
+                return "done"
+            case "suspect":
+                self.__suspect(int(args[0]), str(args[1]), int(args[2]))
+                return "done"
+            case "successor_leaving":
+                self.__successor_leaving(int(args[0]), args[1])
+                return "done"
+            case "direct_store":
+                return self.__direct_store(int(args[0]), str(args[1]), args[2])
+            case "lookup":
+                return self.__lookup(int(args[0]), str(args[1]))
+            case "lookup_page":
+                return self.__lookup(
+                    int(args[0]), str(args[1]), self.__parse_page(args[2:4])
+                )
+            case "lookup_range":
+                bounds = [args[1], args[2] if len(args) > 2 else None]
+                return self.__lookup(
+                    int(args[0]),
+                    self.__parse_query(bounds),
+                    self.__parse_page(args[3:5]),
+                )
+            case "lookup_all":
+                return self.__lookup(
+                    int(args[0]), [None, None], self.__parse_page(args[1:3])
+                )
+            case "direct_lookup":
+                return self.__direct_lookup(
+                    int(args[0]),
+                    self.__parse_query(args[1]),
+                    bool(args[2]) if len(args) > 2 else False,
+                    self.__parse_page(args[3] if len(args) > 3 else None),
+                    args[4] if len(args) > 4 else None,
+                )
+            case "lookup_many":
+                return self.__lookup_many(args[0], int(args[1]) if len(args) > 1 else 0)
+            case "forward_lookup":
+                return list(
+                    self.__forward_lookup(
+                        int(args[0]),
+                        self.__parse_query(args[1]),
+                        str(args[2]),
+                        int(args[3]),
+                        self.__parse_page(args[4] if len(args) > 4 else None),
+                        args[5] if len(args) > 5 else None,
                     )
+                )
+            case "invalidate_value":
+                self.__value_cache.invalidate(
+                    (int(args[0]), str(args[1])), int(args[2])
+                )
+                return "done"
+            # For debugging
+            case "get_self":
+                print(NodeInfo(self.id, self.host, self.port))
+                return "done"
+            case "get_finger_table":
+                if len(args) > 0:
+                    print(self.__finger_table.entry_str(int(args[0])))
                 else:
-                    successor = self.__successor_list[0]
-                break
-            except Exception:
-                n = self.__find_predecessor(id)
-                continue
-        # If you are the successor
+                    for i in range(self.__finger_table.size):
+                        print(self.__finger_table.entry_str(i))
+                return "done"
+            case "get_successor_list":
+                if len(args) > 0:
+                    print(self.__successor_list[int(args[0])])
+                else:
+                    for entry in self.__successor_list:
+                        print(entry)
+                return "done"
+            case "get_predecessor":
+                print(self.__predecessor)
+                return "done"
+            case "get_route":
+                _, _, path = self.__find_route(int(args[0]))
+                for node in path:
+                    print(node)
+                return "done"
+            case "get_data":
+                with self.data_lock:
+                    if len(self.data) > 0:
+                        for chord_key, entries in self.data.items():
+                            for data_key in entries:
+                                print(f"Chord key: {chord_key}, Data Key: {data_key}, Data: {entries[data_key]}")
+                    else:
+                        print("Node has no data")
+                return "done"
+            case _:
+                return "invalid"
+
+    def __find_successor(self, id: int):
+        _, successor, _ = self.__find_route(id)
         return successor
 
     def __find_predecessor(self, id: int):
-        # You are the predecessor
+        predecessor, _, _ = self.__find_route(id)
+        return predecessor
+
+    # Iterative routing, returns the predecessor of id, its successor and the
+    # nodes visited on the way. Each hop costs a single route_step request
+    def __find_route(self, id: int):
+        cached = self.__cached_route(id)
+        if cached is not None:
+            return cached
+        n = NodeInfo(self.id, self.host, self.port)
+        path = [n]
+        is_predecessor, node = self.__route_step(id)
+        while not is_predecessor:
+            try:
+                is_predecessor, next_node = send_command_with_response(
+                    "route_step", node.host, node.port, id
+                )
+            except Exception:
+                self.__remove_failed_node(node.id)
+                # The node that sent us there would keep sending us there
+                if n.id != self.id:
+                    try:
+                        send_command(
+                            "suspect", n.host, n.port, node.id, node.host, node.port
+                        )
+                    except Exception:
+                        pass
+                n = NodeInfo(self.id, self.host, self.port)
+                path = [n]
+                is_predecessor, node = self.__route_step(id)
+                continue
+            n = node
+            path.append(n)
+            node = next_node
+        self.__location_cache.put(n, node)
+        return n, node, path
+
+    # A cached owner only has to confirm that it is still the predecessor of id
+    def __cached_route(self, id: int):
+        cached = self.__location_cache.get(id)
+        if cached is None:
+            return None
+        owner, _, _ = cached
+        try:
+            is_predecessor, successor = send_command_with_response(
+                "route_step", owner.host, owner.port, id
+            )
+        except Exception:
+            self.__remove_failed_node(owner.id)
+            return None
+        # An owner that believes to be alone in the ring restarted and hasn't
+        # joined again yet
+        if not is_predecessor or successor.id == owner.id:
+            self.__location_cache.invalidate(owner.id)
+            return None
+        self.__location_cache.put(owner, successor)
+        return owner, successor, [NodeInfo(self.id, self.host, self.port), owner]
+
+    # Either "I am the predecessor of id, here is my successor" or "ask node next"
+    def __route_step(self, id: int):
+        successor = self.__successor_list[0]
         if self.__circular_range(
-            id, self.id + 1, self.__successor_list[0].id + 1
-        ):  # id not in (self.id, self.successor], [self.id+1, self.successor+1)
-            return NodeInfo(self.id, self.host, self.port)
-        # You are not the predecessor
-        n = self.__closest_preceeding_finger(id)
-        if n.id != self.id:
-            while True:
-                try:
-                    successor = send_command_with_response(
-                        "get_your_successor", n.host, n.port
-                    )
-                    if self.__circular_range(
-                        id, n.id + 1, successor.id + 1
-                    ):  # id in (n.id, successor]
-                        break
-                    n = send_command_with_response(
-                        f"closest_preceeding_finger {id}", n.host, n.port
-                    )
-                except Exception:
-                    self.__remove_node_from_finger_table(n.id)
-                    n = self.__closest_preceeding_finger(id)
-                    continue
-        return n
+            id, self.id + 1, successor.id + 1
+        ):  # id in (self.id, self.successor], [self.id+1, self.successor+1)
+            return True, successor
+        return False, self.__next_hop(id)
 
     def __closest_preceeding_finger(self, id: int):
-        for i in range(P2PNode.hash_size - 1, -1, -1):
-            if self.__circular_range(
-                self.__finger_table[i].node.id, self.id + 1, id
-            ):  # node.id in (self.id, id), thus [self.id+1, id)
-                return self.__finger_table[i].node
-        return NodeInfo(self.id, self.host, self.port)
+        with self.__lock:
+            return self.__finger_table.closest_preceeding(id)
 
     def __initialize_network(self):
         n = NodeInfo(self.id, self.host, self.port)
-        for i in range(0, P2PNode.hash_size):
-            self.__finger_table[i].node = n
-        self.__predecessor = n
-        self.__stabilize_thread.start()
-        self.__fix_fingers_thread.start()
-        self.__ping_successors_thread.start()
+        with self.__lock:
+            self.__finger_table.reset()
+            self.__predecessor = n
+        self.__in_ring = True
+        self.__start_maintenance()
 
     def __join(self, inviter_host: str, inviter_port: int):
         self.__predecessor = NodeInfo(self.id, self.host, self.port)
         try:
-            self.__successor_list[0] = send_command_with_response(
-                f"find_successor {self.__finger_table[0].start}",
+            successor = send_command_with_response(
+                "find_successor",
                 inviter_host,
                 inviter_port,
+                self.__finger_table.start(0),
             )
-            self.__stabilize_thread.start()
-            self.__fix_fingers_thread.start()
-            self.__ping_successors_thread.start()
+            self.__warm_start(successor)
+            self.__in_ring = True
+            self.__fix_fingers_event.set()
+            self.__start_maintenance()
         except Exception:
             print("The inviter node can't be accessed")
 
+    # Copies the successor's routing state in one request, its successor list
+    # continues ours and its fingers are close to our own since it is next to
+    # us on the ring. The finger sweep then only has to fix what differs
+    def __warm_start(self, successor):
+        try:
+            predecessor, successor_list, finger_nodes = send_command_with_response(
+                "get_routing_state", successor.host, successor.port
+            )
+        except Exception:
+            predecessor, successor_list, finger_nodes = successor, [], []
+        with self.__lock:
+            successors = [successor] + [
+                node for node in successor_list if node.id != self.id
+            ]
+            for i in range(len(self.__successor_list)):
+                if i < len(successors):
+                    self.__successor_list[i] = successors[i]
+                else:
+                    self.__successor_list[i] = NodeInfo(self.id, self.host, self.port)
+            for node in finger_nodes + successors + [predecessor]:
+                self.__finger_table.add(node)
+
+    def __start_maintenance(self):
+        if self.__maintenance_threads:
+            self.__stabilize_thread.start()
+            self.__fix_fingers_thread.start()
+            self.__heartbeat_thread.start()
+
+    def __stop_maintenance(self):
+        self.__active = False
+        self.__fix_fingers_event.set()
+        for thread in (
+            self.__stabilize_thread,
+            self.__fix_fingers_thread,
+            self.__heartbeat_thread,
+        ):
+            if thread.is_alive():
+                thread.join()
+
     def __stabilize(self):
         while self.__active:
-            exit_flag = False
-            while not exit_flag:
-                try:
-                    successor = self.__successor_list[0]
-                    if successor.id != self.id:
-                        successors_predecessor = send_command_with_response(
-                            "get_your_predecessor", successor.host, successor.port
-                        )
-                        # Edge case where successor's predecessor has left
-                        try:
-                            send_command(
-                                "ping",
-                                successors_predecessor.host,
-                                successors_predecessor.port,
-                            )
-                        except Exception:
-                            send_command(
-                                f"notify {self.id} {self.host} {self.port}",
-                                successor.host,
-                                successor.port,
-                            )
-                    else:
-                        successors_predecessor = self.__predecessor
-                    if self.__circular_range(
-                        successors_predecessor.id, self.id + 1, successor.id
-                    ):  # successors_predecessor not in (self.id, successor.id), thus [self.id+1, successor.id)
-                        successor = successors_predecessor
-
-                    self.__successor_list[0] = successor
-                    #Potentially transfer keys to successor (will happen when new node has joined)
-                    if self.id != self.__successor_list[0].id:
-                        deleted_keys = []
-                        for chord_key in self.data.keys():
-                            if not self.__circular_range(chord_key, self.id, self.__successor_list[0].id):
-                                self.__transfer_keys(self.__successor_list[0], chord_key, self.data[chord_key])
-                                deleted_keys.append(chord_key)
-                        for key in deleted_keys:
-                            del self.data[key]
-
-                    for i in range(1, len(self.__successor_list)):
-                        self.__successor_list[i] = send_command_with_response(
-                            "get_your_successor",
-                            self.__successor_list[i - 1].host,
-                            self.__successor_list[i - 1].port,
-                        )
-                        exit_flag = True
-                    if self.id != successor.id:
-                        send_command(
-                            f"notify {self.id} {self.host} {self.port}",
-                            successor.host,
-                            successor.port,
-                        )
-                except Exception:
-                    continue
-            time.sleep(self.__stabilize_interval)
+            # A failed round is retried right away
+            if self.stabilize_round():
+                time.sleep(self.__stabilize_interval)
+
+    # Returns whether the round got through. Nodes that haven't joined or have
+    # stopped skip their rounds, hosts may still fire their timers
+    def stabilize_round(self):
+        if not self.__in_ring or not self.__active:
+            return False
+        try:
+            successor = current = self.__successor_list[0]
+            successors = list(self.__successor_list)
+            if successor.id != self.id:
+                successors_predecessor, successors = send_heartbeat_command(
+                    successor.host, successor.port
+                )
+                # Edge case where successor's predecessor has left
+                if not self.__alive(successors_predecessor):
+                    send_command(
+                        "notify",
+                        successor.host,
+                        successor.port,
+                        self.id,
+                        self.host,
+                        self.port,
+                    )
+            else:
+                successors_predecessor = self.__predecessor
+            if self.__circular_range(
+                successors_predecessor.id, self.id + 1, successor.id
+            ):  # successors_predecessor not in (self.id, successor.id), thus [self.id+1, successor.id)
+                successor = successors_predecessor
+                _, successors = send_heartbeat_command(successor.host, successor.port)
+
+            with self.__lock:
+                # A leaving successor may have been replaced meanwhile
+                if self.__successor_list[0].id != current.id:
+                    return False
+                if self.__successor_list[0].id != successor.id:
+                    self.__fix_fingers_event.set()
+                self.__successor_list[0] = successor
+                self.__finger_table.add(successor)
+            #Potentially transfer keys to successor (will happen when new node has joined)
+            if self.id != successor.id:
+                # Keys outside of [self.id, successor.id)
+                moved_keys = self.extract_data(successor.id, self.id)
+                self.__release_copies(successor.id, self.id)
+                if not self.__transfer_keys(successor, moved_keys):
+                    # Keep the keys so a later round hands them over
+                    self.merge_data(moved_keys)
+
+            self.__adopt_successors(successor, successors)
+            if self.id != successor.id:
+                send_command(
+                    "notify",
+                    successor.host,
+                    successor.port,
+                    self.id,
+                    self.host,
+                    self.port,
+                )
+        except Exception:
+            return False
+        self.__sync_replicas()
+        self.metrics.count("rounds.stabilize")
+        return True
 
     def __notify(self, id: int, host: str, port: int):
-        if self.__circular_range(id, self.__predecessor.id, self.id):
-            self.__predecessor = NodeInfo(id, host, port)
+        failure_detector.heard(host, port)
+        with self.__lock:
+            new_predecessor = self.__circular_range(id, self.__predecessor.id, self.id)
+            if new_predecessor:
+                self.__predecessor = NodeInfo(id, host, port)
+            predecessor = self.__predecessor
+        if new_predecessor:
+            self.__fix_fingers_event.set()
             #Potentially transfer keys to predecessor (will happen when new node has joined)
-            if self.id != self.__predecessor.id:
-                deleted_keys = []
-                for chord_key in self.data.keys():
-                    if self.__circular_range(chord_key, self.__predecessor.id, self.id):
-                        self.__transfer_keys(self.__predecessor, chord_key, self.data[chord_key])
-                        deleted_keys.append(chord_key)
-                for key in deleted_keys:
-                    del self.data[key]
+            if self.id != predecessor.id:
+                moved_keys = self.extract_data(predecessor.id, self.id)
+                self.__release_copies(predecessor.id, self.id)
+                if not self.__transfer_keys(predecessor, moved_keys):
+                    self.merge_data(moved_keys)
         else:
             #Check if your old predecessor is still online, if not replace
-            try:
-                send_command("ping", self.__predecessor.host, self.__predecessor.port)
-            except Exception:
-                self.__predecessor = NodeInfo(id, host, port)
+            if not self.__alive(predecessor):
+                with self.__lock:
+                    replaced = self.__predecessor is predecessor
+                    if replaced:
+                        self.__predecessor = NodeInfo(id, host, port)
+                self.__fix_fingers_event.set()
+                if replaced:
+                    self.__promote_replicas(predecessor, NodeInfo(id, host, port))
                 #print("Updated predecessor, because the previous one left")
         #print(f"{self.host}:{self.port}: Finished notify from {host}:{port}", flush=True)
 
     def __fix_fingers(self):
         while self.__active:
-            i = random.randint(0, 127)
-            self.__finger_table[i].node = self.__find_successor(
-                self.__finger_table[i].start
-            )
+            self.__fix_fingers_event.wait(self.__finger_refresh_interval)
+            if not self.__active:
+                break
+            self.fix_fingers_round()
             time.sleep(self.__fix_fingers_interval)
 
-    def __ping_successors(self):  # Remove nodes that left from successor list
+    # Sweeps the fingers if the membership changed since the last sweep or the
+    # refresh interval passed, returns whether it did
+    def fix_fingers_round(self):
+        if not self.__in_ring or not self.__active:
+            return False
+        if (
+            not self.__fix_fingers_event.is_set()
+            and self.__clock() - self.__last_sweep < self.__finger_refresh_interval
+        ):
+            return False
+        self.__fix_fingers_event.clear()
+        self.__last_sweep = self.__clock()
+        self.__sweep_fingers()
+        return True
+
+    # Refreshes one finger per run of fingers sharing a node, all in parallel,
+    # and repeats while the results keep uncovering new runs
+    def __sweep_fingers(self):
+        self.metrics.count("rounds.fix_fingers")
+
+        def find(i):
+            return self.__find_successor(self.__finger_table.start(i))
+
+        for _ in range(P2PNode.hash_size):
+            with self.__lock:
+                leaders = self.__finger_table.leaders()
+                known = [self.__finger_table.get(i).id for i in leaders]
+            self.metrics.count("fix_fingers.lookups", len(leaders))
+            # Hosts without maintenance threads get no parallel lookups either
+            if self.__maintenance_threads:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    nodes = list(executor.map(find, leaders))
+            else:
+                nodes = list(map(find, leaders))
+            with self.__lock:
+                for i, node in zip(leaders, nodes):
+                    self.__finger_table.update(i, node)
+            if [node.id for node in nodes] == known:
+                break
+
+    def __heartbeat(self):
         while self.__active:
-            for i in range(len(self.__successor_list)):
-                if self.__successor_list[i].id != self.id:
-                    try:
-                        send_command(
-                            "ping",
-                            self.__successor_list[i].host,
-                            self.__successor_list[i].port,
-                        )
-                    except Exception:
-                        self.__successor_list.remove(self.__successor_list[i])
-                        self.__successor_list.append(
-                            NodeInfo(self.id, self.host, self.port)
-                        )
-            time.sleep(self.__ping_successors_interval)
+            self.heartbeat_round()
+            time.sleep(self.__heartbeat_interval)
+
+    # Sends a heartbeat to each neighbor we haven't heard from for an interval
+    # and forgets the ones that don't answer. The first successor's reply
+    # refreshes our successor list between stabilize rounds
+    def heartbeat_round(self):
+        if not self.__in_ring or not self.__active:
+            return
+        with self.__lock:
+            neighbors = list(self.__successor_list) + [self.__predecessor]
+        contacted = {self.id}
+        for node in neighbors:
+            if node.id in contacted:
+                continue
+            contacted.add(node.id)
+            if not failure_detector.idle(
+                node.host, node.port, self.__heartbeat_interval
+            ):
+                continue
+            self.metrics.count("heartbeats")
+            try:
+                _, successors = send_heartbeat_command(node.host, node.port)
+            except Exception:
+                self.__remove_failed_node(node.id)
+                self.metrics.count("failures.neighbor")
+                continue
+            if node.id == neighbors[0].id:
+                self.__adopt_successors(node, successors)
+        self.metrics.count("rounds.heartbeat")
+
+    # Our successor list continues with the successor's own list, unless the
+    # successor changed meanwhile
+    def __adopt_successors(self, successor, successors):
+        with self.__lock:
+            if self.__successor_list[0].id != successor.id:
+                return
+            size = len(self.__successor_list)
+            successors = list(successors[: size - 1])
+            while len(successors) < size - 1:
+                successors.append(NodeInfo(self.id, self.host, self.port))
+            self.__successor_list[1:] = successors
+
+    # A node is alive if it answered anything lately or answers a heartbeat now
+    def __alive(self, node):
+        if node.id == self.id or not failure_detector.idle(
+            node.host, node.port, self.__heartbeat_interval
+        ):
+            return True
+        try:
+            send_heartbeat_command(node.host, node.port)
+            return True
+        except Exception:
+            return False
 
     def __leave(self):
-        # Send data to predecessor
-        for chord_key in self.data.keys():
-            while True:
-                if self.id != self.__predecessor.id:
-                    self.__transfer_keys(self.__predecessor, chord_key, self.data[chord_key])
-                    break
+        with self.__lock:
+            predecessor = self.__predecessor
+            successors = list(self.__successor_list)
+        if predecessor.id == self.id:
+            return
+        # Our replicas must not promote the keys we are about to hand over
+        for node in self.__replica_set():
+            try:
+                send_command("replica_drop", node.host, node.port, self.id)
+            except Exception:
+                pass
+        data = self.extract_all_data()
+        self.__release_copies()
+        # If the predecessor we know of is gone too, route to the live one and
+        # as a last resort hand the keys to the successor, which passes them on
+        candidates = [predecessor, None, successors[0]]
+        for candidate in candidates:
+            try:
+                if candidate is None:
+                    candidate = self.__find_predecessor(self.id)
+                if candidate.id == self.id:
+                    continue
+                # Take ourselves out of its successor list first, so that it
+                # doesn't hand our keys straight back to us while stabilizing
+                send_command_with_response(
+                    "successor_leaving",
+                    candidate.host,
+                    candidate.port,
+                    self.id,
+                    successors,
+                )
+            except Exception:
+                continue
+            # Send data to predecessor
+            if self.__transfer_keys(candidate, data):
+                return
 
-    def __remove_node_from_finger_table(self, id):
-        for i in range(len(self.__finger_table)):
-            if self.__finger_table[i].node.id == id and i > 0:
-                self.__finger_table[i].node = self.__finger_table[i - 1].node
-            else:
-                self.__finger_table[i].node = NodeInfo(self.id, self.host, self.port)
+    def __successor_leaving(self, id: int, successors):
+        with self.__lock:
+            successors = [
+                node
+                for node in self.__successor_list + successors
+                if node.id != id and node.id != self.id
+            ]
+            for i in range(len(self.__successor_list)):
+                if i < len(successors):
+                    self.__successor_list[i] = successors[i]
+                else:
+                    self.__successor_list[i] = NodeInfo(self.id, self.host, self.port)
+            self.__finger_table.remove(id)
+        self.__location_cache.invalidate(id)
+        self.__fix_fingers_event.set()
+
+    # A peer couldn't reach the node, it is probed even if we heard from it
+    # lately since that was before the peer's attempt
+    def __suspect(self, id: int, host: str, port: int):
+        try:
+            send_heartbeat_command(host, port)
+        except Exception:
+            self.__remove_failed_node(id)
+
+    # Forgets a node that stopped answering, routes must not be retried
+    # through it while waiting for the next heartbeat
+    def __remove_failed_node(self, id):
+        with self.__lock:
+            self.__finger_table.remove(id)
+            successors = [node for node in self.__successor_list if node.id != id]
+            while len(successors) < len(self.__successor_list):
+                successors.append(NodeInfo(self.id, self.host, self.port))
+            self.__successor_list[:] = successors
+        self.__location_cache.invalidate(id)
+        self.__fix_fingers_event.set()
 
     def __circular_range(self, value, start, end):
         if start < end:
@@ -411,68 +1083,606 @@ class ChordNode(P2PNode):
     def __store(self, chord_key:int, data_key:str, data):
         if self.__circular_range(chord_key, self.id + 1, self.__successor_list[0].id):
             self.store_data(chord_key, data_key, data)
+            self.__replicate([[chord_key, data_key, data]])
+            self.__invalidate_copies(self.__hot_keys.write([(chord_key, data_key)]))
+            self.metrics.observe("store_hops", 0)
         else:
+            cached = self.__location_cache.get(chord_key)
+            if cached is not None:
+                owner, _, _ = cached
+                try:
+                    if send_direct_store_command(
+                        owner.host, owner.port, chord_key, data_key, data
+                    ):
+                        self.metrics.observe("store_hops", 1)
+                        return
+                    self.__location_cache.invalidate(owner.id)
+                except RemoteError:
+                    raise
+                except Exception:
+                    self.__remove_failed_node(owner.id)
             while True:
                 try:
-                    node = self.__find_predecessor(chord_key)
+                    node, _, path = self.__find_route(chord_key)
                     send_store_command(node.host, node.port, chord_key, data_key, data)
+                    # Every node on the path after us was asked for a route step
+                    self.metrics.observe("store_hops", len(path))
                     break
                 except Exception:
                     continue
 
-    def __lookup(self, chord_key, data_key):
-        if self.__circular_range(chord_key, self.id + 1, self.__successor_list[0].id):
-            return self.get_data(chord_key, data_key)
-        else:
-            lookup_port = random.randint(10000, 12000)
-            lookup_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            lookup_socket.bind((self.host, lookup_port))
-            while True:
+    # Splits the indices of chord_keys into the ones we own and groups per
+    # owning node. Keys are walked in ring order so a single route resolves
+    # every key owned by the same node
+    def __group_by_owner(self, chord_keys):
+        local = []
+        groups = {}
+        owner = owner_successor = None
+        successor = self.__successor_list[0]
+        for i in sorted(
+            range(len(chord_keys)),
+            key=lambda i: (chord_keys[i] - self.id) % P2PNode.hash_max_num,
+        ):
+            chord_key = chord_keys[i]
+            if self.__circular_range(chord_key, self.id + 1, successor.id):
+                local.append(i)
+                continue
+            if owner is None or not self.__circular_range(
+                chord_key, owner.id + 1, owner_successor.id
+            ):
+                owner, owner_successor, _ = self.__find_route(chord_key)
+                groups.setdefault(owner.id, (owner, []))
+            groups[owner.id][1].append(i)
+        return local, list(groups.values())
+
+    # Stores a batch of (chord_key, data_key, data) items, each owner receives
+    # its share as one store_many batch
+    def __store_many(self, items, hops=0):
+        if hops >= P2PNode.hash_size:
+            raise RuntimeError(f"Batch store exceeded {hops} hops")
+        items = [
+            [int(chord_key), str(data_key), data] for chord_key, data_key, data in items
+        ]
+        local, groups = self.__group_by_owner([item[0] for item in items])
+        if len(local) > 0:
+            entries = {}
+            for i in local:
+                chord_key, data_key, data = items[i]
+                entries.setdefault(chord_key, {}).setdefault(data_key, []).append(data)
+            self.merge_data(entries)
+            self.__replicate([items[i] for i in local])
+            self.__invalidate_copies(
+                self.__hot_keys.write([(items[i][0], items[i][1]) for i in local])
+            )
+        if len(groups) == 0:
+            return
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(8, len(groups))) as executor:
+            futures = []
+            for node, indices in groups:
+                group = [items[i] for i in indices]
+                future = executor.submit(
+                    send_store_many_command, node.host, node.port, group, hops + 1
+                )
+                futures.append((node, group, future))
+            for node, group, future in futures:
                 try:
-                    node = self.__find_predecessor(chord_key)
-                    send_command_async(f"propagate_lookup {chord_key} {data_key} {self.host} {lookup_port}", node.host, node.port)
-                    break
+                    future.result()
+                except RemoteError:
+                    raise
                 except Exception:
-                    continue
-            lookup_socket.listen(5)
-            lookup_connection, peer_addr = lookup_socket.accept()
-            lookup_connection.settimeout(10.0)
-            response = pickle.loads(lookup_connection.recv(10240))
-            lookup_connection.send("done".encode("utf-8"))
-            lookup_connection.close()
-            return response
-
-    def __propagate_lookup(self, chord_key, data_key, asker_host, asker_port):
-        time.sleep(2) #Make sure that asker is ready to get response
-        if self.__circular_range(chord_key, self.id + 1, self.__successor_list[0].id):
-            comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            comm_socket.settimeout(5.0)
-            comm_socket.connect((asker_host, asker_port))
-            comm_socket.send(
-                 pickle.dumps(self.get_data(chord_key, data_key))
-            )
-            _ = comm_socket.recv(1024)
-            comm_socket.close()
-        else:
-            while True:
+                    self.__remove_failed_node(node.id)
+                    failed.extend(group)
+        if len(failed) > 0:
+            self.__store_many(failed, hops + 1)
+
+    # Looks up a batch of (chord_key, data_key) pairs. Each owner is asked for
+    # all of its keys at once and concurrently with the others, the results
+    # come back in request order as [True, values] or [False, error] per key
+    def __lookup_many(self, keys, hops=0):
+        keys = [[int(chord_key), str(data_key)] for chord_key, data_key in keys]
+        if hops >= P2PNode.hash_size:
+            return [[False, f"Lookup exceeded {hops} hops"] for _ in keys]
+        results = [None] * len(keys)
+        local, groups = self.__group_by_owner([key[0] for key in keys])
+        for i in local:
+            results[i] = [True, self.get_data(keys[i][0], keys[i][1])]
+        if len(groups) == 0:
+            return results
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(8, len(groups))) as executor:
+            futures = []
+            for node, indices in groups:
+                future = executor.submit(
+                    send_lookup_many_command,
+                    node.host,
+                    node.port,
+                    [keys[i] for i in indices],
+                    hops + 1,
+                )
+                futures.append((node, indices, future))
+            for node, indices, future in futures:
                 try:
-                    node = self.__find_predecessor(chord_key)
-                    send_command(f"propagate_lookup {chord_key} {data_key} {asker_host} {asker_port}", node.host, node.port)
-                    break
+                    for i, result in zip(indices, future.result()):
+                        results[i] = result
+                except RemoteError as e:
+                    for i in indices:
+                        results[i] = [False, str(e)]
                 except Exception:
-                    continue
+                    self.__remove_failed_node(node.id)
+                    failed.extend(indices)
+        if len(failed) > 0:
+            retried = self.__lookup_many([keys[i] for i in failed], hops + 1)
+            for i, result in zip(failed, retried):
+                results[i] = result
+        return results
 
-    def __transfer_keys(self, destination_node, chord_key, data):
-        for data_key in data.keys():
-            for entry in data[data_key]:
-                while True:
-                    try:
-                        send_transfer_receive_command(destination_node.host, destination_node.port, chord_key, data_key, entry)
-                        break
-                    except Exception:
+    # Only stores the value if this node owns chord_key, returns whether it did
+    def __direct_store(self, chord_key, data_key, data):
+        if not self.__in_ring or not self.__circular_range(
+            chord_key, self.id + 1, self.__successor_list[0].id
+        ):
+            return False
+        self.store_data(chord_key, data_key, data)
+        self.__replicate([[chord_key, data_key, data]])
+        self.__invalidate_copies(self.__hot_keys.write([(chord_key, data_key)]))
+        return True
+
+    # A query is either a data key or a [low, high] range of numeric data keys,
+    # ranges return [data_key, values] pairs in data key order. A page
+    # [offset, limit] only returns that slice of the values or pairs
+    def __lookup(self, chord_key, query, page=None):
+        values, _, _, _, hops, _ = self.__forward_lookup(
+            chord_key, query, uuid.uuid4().hex, 0, page
+        )
+        self.metrics.observe("lookup_hops", hops)
+        return values
+
+    def __parse_query(self, query):
+        if isinstance(query, list):
+            return [float(bound) if bound is not None else None for bound in query]
+        return str(query)
+
+    def __parse_page(self, page):
+        if page is None or len(page) == 0:
+            return None
+        limit = page[1] if len(page) > 1 else None
+        return [int(page[0]), int(limit) if limit is not None else None]
+
+    def __query_data(self, chord_key, query, page=None):
+        offset, limit = page if page is not None else (0, None)
+        if isinstance(query, list):
+            return self.get_data_range(chord_key, query[0], query[1], offset, limit)
+        return self.get_data(chord_key, query, offset, limit)
+
+    # Returns [owned, values, version], values are only looked up if this node
+    # owns chord_key, or holds a replica of it when asked for one. The version
+    # is set if the sender may cache the values, see __lease
+    def __direct_lookup(
+        self, chord_key, query, replica=False, page=None, sender=None
+    ):
+        if replica:
+            offset, limit = page if page is not None else (0, None)
+            with self.data_lock:
+                for owner_id, (start, end) in self.__replica_ranges.items():
+                    if not self.__circular_range(chord_key, start, end):
                         continue
+                    replicas = self.__replicas[owner_id]
+                    if isinstance(query, list):
+                        return [
+                            True,
+                            replicas.get_range(
+                                chord_key, query[0], query[1], offset, limit
+                            ),
+                            None,
+                        ]
+                    values = replicas.get(chord_key, query, offset, limit)
+                    values = values if values is not None else ["Not Found"]
+                    return [True, values, None]
+            return [False, None, None]
+        successor = self.__successor_list[0]
+        if not self.__in_ring or not self.__circular_range(
+            chord_key, self.id + 1, successor.id
+        ):
+            return [False, None, None]
+        version = self.__lease(chord_key, query, page, sender)
+        return [True, self.__query_data(chord_key, query, page), version]
+
+    # Recursive lookup, every hop forwards the request one step closer to the
+    # owner and the value travels back as the response of each forwarded request
+    # together with the owner, so every node on the path learns where it lives.
+    # Only the node that asked the owner itself may cache a hot value, since
+    # only it hears of the value's invalidation, so the version returned is
+    # meant for the sender alone
+    def __forward_lookup(
+        self, chord_key, query, request_id, hops, page=None, sender=None
+    ):
+        successor = self.__successor_list[0]
+        if self.__circular_range(chord_key, self.id + 1, successor.id):
+            version = self.__lease(chord_key, query, page, sender)
+            return (
+                self.__query_data(chord_key, query, page),
+                NodeInfo(self.id, self.host, self.port),
+                successor,
+                self.__replica_set(),
+                hops,
+                version,
+            )
+        if hops >= P2PNode.hash_size:
+            raise RuntimeError(f"Lookup {request_id} exceeded {hops} hops")
+        key = (chord_key, query) if page is None and isinstance(query, str) else None
+        if key is not None:
+            cached = self.__value_cache.get(key)
+            if cached is not None:
+                values, (owner, successor, replicas) = cached
+                self.metrics.count("hot_keys.hits")
+                return values, owner, successor, replicas, hops, None
+        me = NodeInfo(self.id, self.host, self.port)
+        cached = self.__location_cache.get(chord_key)
+        if cached is not None:
+            owner, successor, replicas = cached
+            targets = [owner]
+            if self.__read_from_replicas and len(replicas) > 0:
+                # Spread the reads of hot keys over the owner and its replicas
+                targets.insert(0, random.choice([owner] + replicas))
+            for target in targets:
+                try:
+                    requested = self.__clock()
+                    owned, values, version = send_direct_lookup_command(
+                        target.host,
+                        target.port,
+                        chord_key,
+                        query,
+                        target.id != owner.id,
+                        page,
+                        me,
+                    )
+                    if owned:
+                        if version is not None:
+                            self.__value_cache.put(
+                                key,
+                                version,
+                                requested,
+                                values,
+                                (owner, successor, replicas),
+                            )
+                        return values, owner, successor, replicas, hops + 1, None
+                    if target.id == owner.id:
+                        self.__location_cache.invalidate(owner.id)
+                        break
+                except RemoteError:
+                    raise
+                except Exception:
+                    self.__remove_failed_node(target.id)
+                    if target.id == owner.id:
+                        break
+        while True:
+            node = self.__next_hop(chord_key)
+            try:
+                requested = self.__clock()
+                values, owner, successor, replicas, hops, version = (
+                    send_forward_lookup_command(
+                        node.host,
+                        node.port,
+                        chord_key,
+                        query,
+                        request_id,
+                        hops + 1,
+                        page,
+                        me,
+                    )
+                )
+                self.__location_cache.put(owner, successor, replicas)
+                if version is not None:
+                    self.__value_cache.put(
+                        key, version, requested, values, (owner, successor, replicas)
+                    )
+                return values, owner, successor, replicas, hops, None
+            except RemoteError:
+                raise
+            except Exception:
+                self.__remove_failed_node(node.id)
+                continue
 
+    # Counts a read of a key we own and returns the version of the lease the
+    # sender gets on its values, if the key is hot. Ranges and pages aren't
+    # leased. The lease is granted before the values are read, so a store
+    # racing the read either invalidates the holder or is seen by the read
+    def __lease(self, chord_key, query, page, sender):
+        if page is not None or not isinstance(query, str):
+            return None
+        holder = None
+        if sender is not None and sender.id != self.id:
+            holder = (sender.host, sender.port)
+        version = self.__hot_keys.read((chord_key, query), holder)
+        if version is not None:
+            self.metrics.count("hot_keys.leases")
+        return version
 
-    # Store but will always store on node, not propagate, useful for leave where node transfers keys but hasn't left yet
-    def __transfer_receive(self, chord_key, data_key, data):
-        self.store_data(chord_key, data_key, data)
+    # Tells the holders of leased copies of keys that were written or moved to
+    # another owner to drop them. A holder that can't be reached keeps its copy
+    # only until the lease runs out
+    def __invalidate_copies(self, released):
+        for (chord_key, data_key), version, holders in released:
+            for host, port in holders:
+                try:
+                    send_command(
+                        "invalidate_value", host, port, chord_key, data_key, version
+                    )
+                except Exception:
+                    pass
+            self.metrics.count("hot_keys.invalidations", len(holders))
+
+    # Invalidates the copies of the keys in [start, end), or of every key
+    def __release_copies(self, start=None, end=None):
+        if start is None:
+            released = self.__hot_keys.release(lambda key: True)
+        else:
+            released = self.__hot_keys.release(
+                lambda key: self.__circular_range(key[0], start, end)
+            )
+        self.__invalidate_copies(released)
+
+    def __next_hop(self, id: int):
+        n = self.__closest_preceeding_finger(id)
+        if n.id == self.id:
+            return self.__successor_list[0]
+        return n
+
+    # Streams a whole key range to the destination in chunks. The receiver
+    # stages the chunks and applies them at once on commit, so an interrupted
+    # handoff is resumed by resending only the chunks it is missing
+    def __transfer_keys(self, destination_node, data, replica=None):
+        if len(data) == 0 and replica is None:
+            return True
+        transfer_id = uuid.uuid4().hex
+        chunks = self.__pack_chunks(data)
+        # The receiver ors our filter of the keys into its own
+        key_filter = None
+        if replica is None and self.key_filter is not None:
+            handoff_filter = BloomFilter(
+                self.key_filter.num_bits, self.key_filter.num_hashes
+            )
+            handoff_filter.update(
+                (chord_key, data_key)
+                for chord_key, entries in data.items()
+                for data_key in entries
+            )
+            key_filter = zlib.compress(bytes(handoff_filter.bits), 1)
+        for attempt in range(5):
+            try:
+                received = send_command_with_response(
+                    "transfer_begin",
+                    destination_node.host,
+                    destination_node.port,
+                    transfer_id,
+                )
+                for index, (compressed, payload) in enumerate(chunks):
+                    if index not in received:
+                        send_command_with_response(
+                            "transfer_chunk",
+                            destination_node.host,
+                            destination_node.port,
+                            transfer_id,
+                            index,
+                            compressed,
+                            payload,
+                        )
+                send_command_with_response(
+                    "transfer_commit",
+                    destination_node.host,
+                    destination_node.port,
+                    transfer_id,
+                    len(chunks),
+                    replica,
+                    key_filter,
+                )
+                return True
+            except (ConnectionRefusedError, RemoteError):
+                # The node is gone or refused the keys, only interrupted
+                # handoffs are worth resuming
+                break
+            except Exception:
+                # Without maintenance threads the caller drives the clock,
+                # there is no one to wait for
+                if self.__maintenance_threads:
+                    time.sleep(0.1 * (attempt + 1))
+        return False
+
+    def __pack_chunks(self, data):
+        groups = [[]]
+        size = 0
+        for chord_key, entries in data.items():
+            entry_size = len(encode(entries))
+            if size + entry_size > self.__transfer_chunk_size and len(groups[-1]) > 0:
+                groups.append([])
+                size = 0
+            groups[-1].append((chord_key, entries))
+            size += entry_size
+        chunks = []
+        for group in groups:
+            payload = encode(dict(group))
+            if self.__compress_transfers and len(payload) > 1024:
+                chunks.append((True, zlib.compress(payload, 1)))
+            else:
+                chunks.append((False, payload))
+        return chunks
+
+    def __transfer_begin(self, transfer_id):
+        with self.data_lock:
+            if transfer_id in self.__committed_transfers:
+                return []
+            now = time.monotonic()
+            for stale_id in [
+                id
+                for id, transfer in self.__incoming_transfers.items()
+                if now - transfer["updated"] > 60.0
+            ]:
+                del self.__incoming_transfers[stale_id]
+            transfer = self.__incoming_transfers.setdefault(
+                transfer_id, {"chunks": {}, "updated": now}
+            )
+            return list(transfer["chunks"].keys())
+
+    def __transfer_chunk(self, transfer_id, index, compressed, payload):
+        if compressed:
+            payload = zlib.decompress(payload)
+        chunk = decode(payload)
+        with self.data_lock:
+            if transfer_id in self.__committed_transfers:
+                return
+            transfer = self.__incoming_transfers.setdefault(
+                transfer_id, {"chunks": {}, "updated": time.monotonic()}
+            )
+            transfer["chunks"][index] = chunk
+            transfer["updated"] = time.monotonic()
+
+    # A replica transfer [owner_id, start, end] replaces the copy of the
+    # owner's range instead of adding to our own keys
+    def __transfer_commit(self, transfer_id, num_chunks, replica=None, key_filter=None):
+        with self.data_lock:
+            if transfer_id in self.__committed_transfers:
+                return
+            transfer = self.__incoming_transfers[transfer_id]
+            if len(transfer["chunks"]) != num_chunks:
+                raise RuntimeError(f"Transfer {transfer_id} is missing chunks")
+            if replica is not None:
+                owner_id, start, end = replica
+                replicas = SortedStorage()
+                for index in range(num_chunks):
+                    replicas.merge(transfer["chunks"][index])
+                self.__replicas[owner_id] = replicas
+                self.__replica_ranges[owner_id] = (start, end)
+                # Owners inside the range are gone. Only the node right after
+                # the range promotes their keys, further replicas drop them
+                if end != self.id:
+                    for id in list(self.__replicas):
+                        if id != owner_id and self.__circular_range(id, start, end):
+                            self.__replica_ranges.pop(id, None)
+                            del self.__replicas[id]
+            else:
+                # Our replicas don't have the keys we were handed yet
+                self.__replicated_state = None
+                data = {}
+                for index in range(num_chunks):
+                    data.update(transfer["chunks"][index])
+                if key_filter is not None:
+                    key_filter = zlib.decompress(key_filter)
+                self.merge_data(data, key_filter)
+            del self.__incoming_transfers[transfer_id]
+            self.__committed_transfers[transfer_id] = True
+            if len(self.__committed_transfers) > 1024:
+                self.__committed_transfers.popitem(last=False)
+
+    # First replication_factor - 1 distinct nodes of the successor list that
+    # are not virtual nodes of our own physical node
+    def __replica_set(self):
+        replicas = []
+        with self.__lock:
+            for node in self.__successor_list:
+                if len(replicas) >= self.__replication_factor - 1:
+                    break
+                if (
+                    node.id != self.id
+                    and (node.host, node.port) not in self.__siblings
+                    and all(node.id != r.id for r in replicas)
+                ):
+                    replicas.append(node)
+        return replicas
+
+    # Copies newly stored items to the replicas, a replica that misses them gets
+    # our whole range again on the next sync
+    def __replicate(self, items):
+        if self.__replication_factor <= 1:
+            return
+        with self.data_lock:
+            self.__replica_version += 1
+        for node in self.__replica_set():
+            try:
+                send_command_with_response(
+                    "replicate", node.host, node.port, self.id, items
+                )
+            except Exception:
+                with self.data_lock:
+                    self.__replicated_state = None
+
+    def __replicate_store(self, owner_id, items):
+        entries = {}
+        for chord_key, data_key, data in items:
+            entries.setdefault(int(chord_key), {}).setdefault(data_key, []).append(data)
+        with self.data_lock:
+            self.__replicas.setdefault(owner_id, SortedStorage()).merge(entries)
+
+    def __replica_drop(self, owner_id):
+        with self.data_lock:
+            self.__replica_ranges.pop(owner_id, None)
+            self.__replicas.pop(owner_id, None)
+
+    # Copies our whole range to the replicas whenever the range or the replica
+    # set changed, and tells the nodes that stopped being replicas to drop it
+    def __sync_replicas(self):
+        if self.__replication_factor <= 1:
+            return
+        successor = self.__successor_list[0]
+        replicas = self.__replica_set()
+        state = (successor.id, [node.id for node in replicas])
+        with self.data_lock:
+            if self.__replicated_state == state:
+                return
+            version = self.__replica_version
+            data = {
+                chord_key: {data_key: list(values) for data_key, values in entries.items()}
+                for chord_key, entries in self.data.items()
+            }
+        replica_range = [self.id, self.id + 1, successor.id]
+        synced = True
+        for node in replicas:
+            synced = self.__transfer_keys(node, data, replica_range) and synced
+        for node in self.__replicated_nodes:
+            if node.id not in state[1]:
+                try:
+                    send_command("replica_drop", node.host, node.port, self.id)
+                except Exception:
+                    pass
+        self.__replicated_nodes = replicas
+        with self.data_lock:
+            if synced and version == self.__replica_version:
+                self.__replicated_state = state
+
+    # The keys of failed predecessors now belong to the live node before them,
+    # so our replicas of their ranges become that node's own keys
+    def __promote_replicas(self, failed, owner):
+        if self.__replication_factor <= 1:
+            return
+        data = {}
+        with self.data_lock:
+            for owner_id in list(self.__replicas):
+                if owner_id == failed.id or self.__circular_range(
+                    owner_id, owner.id + 1, self.id
+                ):
+                    self.__replica_ranges.pop(owner_id, None)
+                    for chord_key, entries in self.__replicas.pop(owner_id).items():
+                        data[chord_key] = entries
+            if owner.id != self.id:
+                self.__replicas.setdefault(owner.id, SortedStorage()).merge(data)
+        if owner.id == self.id:
+            self.merge_data(data)
+        else:
+            self.__transfer_keys(owner, data)
+
+    # Metrics of the commands this node served and of the requests its process
+    # sent, reset after reading if asked to
+    def __stats(self, reset=False):
+        with self.data_lock:
+            keys = len(self.data)
+            replicated_keys = sum(
+                len(replicas) for replicas in self.__replicas.values()
+            )
+        return {
+            "node": f"{self.host}:{self.port}",
+            "id": self.id,
+            "keys": keys,
+            "replicated_keys": replicated_keys,
+            "server": self.metrics.snapshot(reset),
+            "client": client_metrics.snapshot(reset),
+        }
@@ -1,7 +1,10 @@
 import hashlib
+import json
 import re
 
-from node.request import send_command, send_lookup_command, send_store_command
+from node.request import (iter_lookup, send_command_with_response,
+                          send_lookup_all_command, send_lookup_many_command,
+                          send_lookup_range_command, send_store_command)
 
 
 def split_command(command):
@@ -16,9 +19,19 @@ def console(processes, exit_flag):
     print(
         'For lookups: "node_host" "node_port" "lookup" "Institution Name" "Number of Awards"'
     )
+    print(
+        'For multiple lookups: "node_host" "node_port" "lookup_many" "Institution Name" "Number of Awards" ...'
+    )
+    print(
+        'For award ranges: "node_host" "node_port" "lookup_range" "Institution Name" "Minimum Awards" ["Maximum Awards"]'
+    )
+    print(
+        'For every entry of an institution: "node_host" "node_port" "lookup_all" "Institution Name"'
+    )
     print(
         'For storing: "node_host" "node_port" "store" "Institution Name" "Number of Awards" "Name of Computer Scientist"'
     )
+    print('For node metrics: "node_host" "node_port" "stats" ["reset"]')
     print('For others: "node_host" "node_port" "command"')
     print('To exit type "exit"')
     print('Example command: "localhost 8080 lookup MIT 15"')
@@ -34,7 +47,7 @@ def console(processes, exit_flag):
         if len(msg) >= 3:
             try:
                 if msg[2] == "lookup" and len(msg) == 5:
-                    results = send_lookup_command(
+                    results = iter_lookup(
                         str(msg[0]),
                         int(msg[1]),
                         int(hashlib.md5((msg[3]).encode()).hexdigest(), 16),
@@ -46,6 +59,51 @@ def console(processes, exit_flag):
                     for result in results:
                         print(result)
 
+                elif msg[2] == "lookup_many" and len(msg) >= 5 and len(msg) % 2 == 1:
+                    pairs = list(zip(msg[3::2], msg[4::2]))
+                    results = send_lookup_many_command(
+                        str(msg[0]),
+                        int(msg[1]),
+                        [
+                            [int(hashlib.md5(institution.encode()).hexdigest(), 16), awards]
+                            for institution, awards in pairs
+                        ],
+                    )
+                    for (institution, awards), (ok, result) in zip(pairs, results):
+                        print(f"Result for Institution: {institution} and #Awards: {awards} is:")
+                        if ok:
+                            for entry in result:
+                                print(entry)
+                        else:
+                            print(f"Error: {result}")
+
+                elif msg[2] in ("lookup_range", "lookup_all") and len(msg) >= 4:
+                    chord_key = int(hashlib.md5((msg[3]).encode()).hexdigest(), 16)
+                    if msg[2] == "lookup_range":
+                        results = send_lookup_range_command(
+                            str(msg[0]),
+                            int(msg[1]),
+                            chord_key,
+                            float(msg[4]) if len(msg) > 4 else None,
+                            float(msg[5]) if len(msg) > 5 else None,
+                        )
+                    else:
+                        results = send_lookup_all_command(
+                            str(msg[0]), int(msg[1]), chord_key
+                        )
+                    print(f"Results for Institution: {msg[3]} are:")
+                    if len(results) == 0:
+                        print("Not Found")
+                    for awards, entries in results:
+                        for entry in entries:
+                            print(f"#Awards: {awards}: {entry}")
+
+                elif msg[2] == "stats":
+                    stats = send_command_with_response(
+                        "stats", str(msg[0]), int(msg[1]), *msg[3:]
+                    )
+                    print(json.dumps(stats, indent=2))
+
                 elif msg[2] == "store" and len(msg) >= 6:
                     send_store_command(
                         str(msg[0]),
@@ -55,7 +113,9 @@ def console(processes, exit_flag):
                         str(msg[5]),
                     )
                 else:
-                    send_command(str(msg[2]), str(msg[0]), int(msg[1]))
+                    send_command_with_response(
+                        str(msg[2]), str(msg[0]), int(msg[1]), *msg[3:]
+                    )
             except Exception:
                 print("Connection Error: Please Try Again")
                 continue
@@ -0,0 +1,176 @@
+import asyncio
+import copy
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from node.chord import ChordNode
+from node.protocol import decode, encode, header, max_message_size
+from node.request import MemoryTransport, SocketTransport, set_transport
+
+
+# Decodes and runs a request on one of the worker threads, returns the command,
+# whether it succeeded and the framed response
+def _execute(node, frame):
+    request = decode(frame)
+    response = node.execute_request(request)
+    payload = encode(response)
+    return request[0], response[0], header.pack(len(payload)) + payload
+
+
+# Runs many ChordNodes in one process on a single asyncio loop. Connections of
+# every node wait on the loop and only requests being executed occupy one of
+# the shared worker threads. Maintenance rounds are fired by timers of the loop
+# instead of three sleeping threads per node, and run on a few threads of their
+# own so that requests never queue behind the rounds of hundreds of nodes.
+# Requests between the nodes of the host are delivered in memory, still
+# serialized so that nodes never share objects, and every other request goes
+# over sockets. Nodes are added before the host runs and it returns once all of
+# them left or were killed
+class NodeHost:
+    def __init__(self, workers=32, maintenance_workers=4):
+        self.workers = workers
+        self.maintenance_workers = maintenance_workers
+        self.nodes = {}  # (host, port) to node
+        self.__settings = {}
+        self.__servers = {}
+        self.__connections = {}  # (host, port) to the writers of its connections
+        self.__loop = None
+        self.__executor = None
+        self.__maintenance_executor = None
+        self.__transport = None
+        self.__done = None
+
+    # Adds a physical node and returns its virtual nodes, which listen on the
+    # settings.virtual_nodes ports starting at port. They share the process,
+    # its worker threads and its connection pool. The settings are copied, the
+    # host drives the maintenance of its nodes
+    def add_node(self, host, port, settings):
+        settings = copy.copy(settings)
+        settings.maintenance_threads = False
+        addresses = [(host, port + i) for i in range(settings.virtual_nodes)]
+        nodes = []
+        for address in addresses:
+            siblings = [sibling for sibling in addresses if sibling != address]
+            node = ChordNode(*address, settings, siblings)
+            self.nodes[address] = node
+            self.__settings[address] = settings
+            nodes.append(node)
+        return nodes
+
+    def run(self):
+        asyncio.run(self.__main())
+
+    async def __main(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__done = asyncio.Event()
+        self.__transport = MemoryTransport(serialize=True, fallback=SocketTransport())
+        # Nothing reads the counters of the transport, spare the bookkeeping
+        self.__transport.counting = False
+        previous_transport = set_transport(self.__transport)
+        self.__executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.__maintenance_executor = ThreadPoolExecutor(
+            max_workers=self.maintenance_workers
+        )
+        try:
+            for node in list(self.nodes.values()):
+                await self.__start(node)
+            if len(self.__servers) > 0:
+                await self.__done.wait()
+        finally:
+            set_transport(previous_transport)
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__maintenance_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __start(self, node):
+        address = (node.host, node.port)
+        server = await asyncio.start_server(
+            lambda reader, writer: self.__serve(node, reader, writer),
+            node.host,
+            node.port,
+            backlog=128,
+            reuse_address=True,
+        )
+        self.__servers[address] = server
+        self.__connections[address] = set()
+        self.__transport.nodes[address] = node
+        print(f"Node {node.id} listening on {node.host}:{node.port}", flush=True)
+        settings = self.__settings[address]
+        for interval, maintenance_round in (
+            (settings.stabilize_interval, node.stabilize_round),
+            (settings.fix_fingers_interval, node.fix_fingers_round),
+            (settings.ping_successors_interval, node.heartbeat_round),
+        ):
+            # Random phases keep the nodes from running their rounds in lockstep
+            delay = interval * random.random()
+            self.__schedule(node, delay, interval, maintenance_round)
+
+    # A round is only rescheduled once it finished, so it never overlaps itself
+    def __schedule(self, node, delay, interval, maintenance_round):
+        address = (node.host, node.port)
+
+        def finished(future):
+            if not future.cancelled() and future.exception() is not None:
+                print(f"{node.host}:{node.port}: {future.exception()}", flush=True)
+            self.__schedule(node, interval, interval, maintenance_round)
+
+        def tick():
+            # Nodes asked to leave by a node of the host never reach our servers
+            if self.__transport.nodes.get(address) is not node:
+                self.__stop(node)
+                return
+            future = self.__loop.run_in_executor(
+                self.__maintenance_executor, maintenance_round
+            )
+            future.add_done_callback(finished)
+
+        self.__loop.call_later(delay, tick)
+
+    async def __serve(self, node, reader, writer):
+        address = (node.host, node.port)
+        connections = self.__connections.get(address)
+        if connections is None:  # The node stopped while the peer connected
+            writer.close()
+            return
+        connections.add(writer)
+        try:
+            while True:
+                (size,) = header.unpack(await reader.readexactly(header.size))
+                if size > max_message_size:
+                    break
+                frame = await reader.readexactly(size)
+                start = time.perf_counter()
+                command, ok, response = await self.__loop.run_in_executor(
+                    self.__executor, _execute, node, frame
+                )
+                writer.write(response)
+                await writer.drain()
+                node.metrics.record_rpc(
+                    command,
+                    time.perf_counter() - start,
+                    header.size + len(frame),
+                    len(response),
+                    ok,
+                )
+                if command in ("leave", "kill"):
+                    self.__stop(node)
+                    break
+        except Exception:  # Peer closed the connection or sent garbage
+            pass
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    # Closes the node's server and connections, the host stops with its last node
+    def __stop(self, node):
+        address = (node.host, node.port)
+        if self.nodes.get(address) is not node:
+            return
+        del self.nodes[address]
+        del self.__settings[address]
+        self.__transport.nodes.pop(address, None)
+        self.__servers.pop(address).close()
+        for writer in self.__connections.pop(address):
+            writer.close()
+        if len(self.__servers) == 0:
+            self.__done.set()
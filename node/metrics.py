@@ -0,0 +1,103 @@
+import threading
+
+
+# Thread safe counters and histograms. Latencies are kept in power of two
+# buckets of microseconds, small integers such as hop counts exactly
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__latencies = {}
+        self.__values = {}
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[value] = values.get(value, 0) + 1
+
+    def observe_latency(self, name, seconds):
+        with self.__lock:
+            self.__observe_latency(name, seconds)
+
+    # One request or response exchange, recorded under a single lock
+    def record_rpc(self, command, seconds, bytes_received, bytes_sent, ok=True):
+        with self.__lock:
+            self.__observe_latency(command, seconds)
+            counters = self.__counters
+            received = counters.get("bytes_received", 0) + bytes_received
+            counters["bytes_received"] = received
+            counters["bytes_sent"] = counters.get("bytes_sent", 0) + bytes_sent
+            if not ok:
+                name = f"errors.{command}"
+                counters[name] = counters.get(name, 0) + 1
+
+    def snapshot(self, reset=False):
+        with self.__lock:
+            counters, latencies, values = (
+                self.__counters,
+                self.__latencies,
+                self.__values,
+            )
+            if reset:
+                self.__counters, self.__latencies, self.__values = {}, {}, {}
+            else:
+                counters = dict(counters)
+                latencies = {
+                    name: dict(histogram, buckets=list(histogram["buckets"]))
+                    for name, histogram in latencies.items()
+                }
+                values = {name: dict(counts) for name, counts in values.items()}
+        return {
+            "counters": counters,
+            "latencies": {
+                name: _summary(histogram) for name, histogram in latencies.items()
+            },
+            "values": values,
+        }
+
+    def __observe_latency(self, name, seconds):
+        histogram = self.__latencies.get(name)
+        if histogram is None:
+            histogram = self.__latencies[name] = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "buckets": [],
+            }
+        bucket = int(seconds * 1_000_000).bit_length()
+        buckets = histogram["buckets"]
+        if bucket >= len(buckets):
+            buckets.extend([0] * (bucket + 1 - len(buckets)))
+        buckets[bucket] += 1
+        histogram["count"] += 1
+        histogram["total"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+
+
+# Percentiles are the upper bound of the bucket they fall in
+def _summary(histogram):
+    def percentile(fraction):
+        target = fraction * histogram["count"]
+        seen = 0
+        for bucket, count in enumerate(histogram["buckets"]):
+            seen += count
+            if seen >= target:
+                return 2**bucket / 1000
+        return histogram["max"] * 1000
+
+    return {
+        "count": histogram["count"],
+        "mean_ms": histogram["total"] * 1000 / max(1, histogram["count"]),
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "max_ms": histogram["max"] * 1000,
+        "buckets_us": {
+            2**bucket: count
+            for bucket, count in enumerate(histogram["buckets"])
+            if count > 0
+        },
+    }
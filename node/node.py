@@ -1,7 +1,25 @@
 import hashlib
+import queue
 import random
+import selectors
 import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from node.storage import BloomFilter, SortedStorage
+
+
+class NodeInfo:
+    __slots__ = ("id", "host", "port")
+
+    def __init__(self, id, host, port):
+        self.id = id
+        self.host = host
+        self.port = port
+
+    def __str__(self):
+        return f"id: {self.id}, host {self.host}, port {self.port}"
 
 
 # Abstract class to be inherited by CordNode and PastryNode classes
@@ -9,38 +27,125 @@ class P2PNode:
     hash_size = 16 * 8
     hash_max_num = 2**hash_size
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, server_threads=16, storage=None, key_filter=None):
         self.id = int(hashlib.md5((host + str(port)).encode()).hexdigest(), 16)
         self.host = host
         self.port = port
-        self.data = {}
+        # Any engine with the SortedStorage interface can hold the node's data
+        self.data = storage if storage is not None else SortedStorage()
+        self.data_lock = threading.RLock()
+        # Optional BloomFilter over the stored keys that answers most misses
+        self.key_filter = key_filter
+        if key_filter is not None:
+            key_filter.update(self.data.keys())
+        self.server_threads = server_threads
 
     def start_node(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(128)
         print(f"Node {self.id} listening on {self.host}:{self.port}", flush=True)
-        while True:
-            peer_connection, peer_addr = self.server_socket.accept()
-            peer_connection.settimeout(10.0)
-            result = self.handle_commands(peer_connection)
-            if result == "close":
-                break
-
-    def handle_commands(self, peer_connection):
+        # Idle connections wait in the selector, only connections with a pending
+        # command occupy one of the worker threads
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.server_socket, selectors.EVENT_READ)
+        self.__wakeup_receiver, self.__wakeup_sender = socket.socketpair()
+        self.__selector.register(self.__wakeup_receiver, selectors.EVENT_READ)
+        self.__parked_connections = queue.SimpleQueue()
+        self.__serving = True
+        with ThreadPoolExecutor(max_workers=self.server_threads) as executor:
+            while self.__serving:
+                for key, _ in self.__selector.select():
+                    if key.fileobj is self.server_socket:
+                        peer_connection, peer_addr = self.server_socket.accept()
+                        peer_connection.settimeout(10.0)
+                        self.__selector.register(peer_connection, selectors.EVENT_READ)
+                    elif key.fileobj is self.__wakeup_receiver:
+                        self.__wakeup_receiver.recv(1024)
+                        while not self.__parked_connections.empty():
+                            self.__selector.register(
+                                self.__parked_connections.get(), selectors.EVENT_READ
+                            )
+                    else:
+                        self.__selector.unregister(key.fileobj)
+                        executor.submit(self.__serve_command, key.fileobj)
+        for key in list(self.__selector.get_map().values()):
+            key.fileobj.close()
+        self.__selector.close()
+        self.__wakeup_sender.close()
+
+    def __serve_command(self, peer_connection):
+        try:
+            result = self.handle_command(peer_connection)
+        except Exception:
+            peer_connection.close()
+            return
+        if result == "close":
+            self.__serving = False
+        elif result == "continue":
+            return
+        else:
+            self.__parked_connections.put(peer_connection)
+        self.__wakeup_sender.send(b"\0")
+
+    # Handles a single command on the connection and returns "keep" if the
+    # connection stays open, "continue" if it was closed or "close" to stop the node
+    def handle_command(self, peer_connection):
         pass
 
     def store_data(self, chord_key, data_key, data):
-        if chord_key in self.data.keys():
-            if data_key in self.data[chord_key].keys():
-                self.data[chord_key][data_key].append(data)
-            else:
-                self.data[chord_key][data_key] = [data]
-        else:
-            self.data[chord_key] = {data_key: [data]}
+        with self.data_lock:
+            if self.key_filter is not None:
+                self.key_filter.add(chord_key, data_key)
+            self.data.store(chord_key, data_key, data)
 
-    def get_data(self, chord_key, data_key):
-        if chord_key in self.data.keys() and data_key in self.data[chord_key].keys():
-            return self.data[chord_key][data_key]
-        else:
+    # Adds every value of a {chord_key: {data_key: [values]}} batch at once.
+    # The bits of a filter over the batch's keys spare hashing them again
+    def merge_data(self, data, key_filter_bits=None):
+        with self.data_lock:
+            if self.key_filter is not None:
+                if key_filter_bits is not None and len(key_filter_bits) == len(
+                    self.key_filter.bits
+                ):
+                    self.key_filter.union(key_filter_bits)
+                else:
+                    self.key_filter.update(
+                        (chord_key, data_key)
+                        for chord_key, entries in data.items()
+                        for data_key in entries
+                    )
+            self.data.merge(data)
+
+    # Removes and returns the keys in the circular interval [start, end). Bloom
+    # filters can't forget keys, the bits of the keys that left only cost
+    # false positives, so the filter is kept rather than rehashing every key
+    def extract_data(self, start, end):
+        with self.data_lock:
+            return self.data.pop_range(start, end)
+
+    def extract_all_data(self):
+        with self.data_lock:
+            data = self.data.pop_all()
+            if self.key_filter is not None:
+                self.key_filter = BloomFilter(
+                    self.key_filter.num_bits, self.key_filter.num_hashes
+                )
+            return data
+
+    # Returns the values in [offset, offset + limit), a limit of None reads to
+    # the end
+    def get_data(self, chord_key, data_key, offset=0, limit=None):
+        key_filter = self.key_filter
+        if key_filter is not None and not key_filter.might_contain(chord_key, data_key):
             return ["Not Found"]
+        with self.data_lock:
+            result = self.data.get(chord_key, data_key, offset, limit)
+        if result is None:
+            return ["Not Found"]
+        return result
+
+    # Returns [data_key, values] pairs of the numeric data keys in [low, high]
+    def get_data_range(self, chord_key, low=None, high=None, offset=0, limit=None):
+        with self.data_lock:
+            return self.data.get_range(chord_key, low, high, offset, limit)
@@ -0,0 +1,85 @@
+import struct
+
+import msgpack
+
+from node.node import NodeInfo
+
+# Every message is a 4 byte big endian length followed by a msgpack payload.
+# Requests are [command, *args] and responses are [ok, result]
+header = struct.Struct(">I")
+max_message_size = 64 * 1024 * 1024
+
+# msgpack only handles 64 bit integers, chord ids need 128 bits
+big_int_ext = 1
+node_info_ext = 2
+
+
+class RemoteError(Exception):
+    pass
+
+
+def _default(obj):
+    if isinstance(obj, int):
+        return msgpack.ExtType(
+            big_int_ext, obj.to_bytes(obj.bit_length() // 8 + 1, "big", signed=True)
+        )
+    if isinstance(obj, NodeInfo):
+        return msgpack.ExtType(node_info_ext, encode([obj.id, obj.host, obj.port]))
+    raise TypeError(f"Can't encode object of type {type(obj).__name__}")
+
+
+def _ext_hook(code, data):
+    if code == big_int_ext:
+        return int.from_bytes(data, "big", signed=True)
+    if code == node_info_ext:
+        return NodeInfo(*decode(data))
+    return msgpack.ExtType(code, data)
+
+
+def encode(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def decode(data):
+    return msgpack.unpackb(
+        data, ext_hook=_ext_hook, raw=False, strict_map_key=False
+    )
+
+
+# Large payloads are sent after the header instead of being copied behind it
+copy_threshold = 64 * 1024
+
+
+# Returns the number of bytes sent
+def send_message(comm_socket, obj):
+    payload = encode(obj)
+    if len(payload) < copy_threshold:
+        comm_socket.sendall(header.pack(len(payload)) + payload)
+    else:
+        comm_socket.sendall(header.pack(len(payload)))
+        comm_socket.sendall(payload)
+    return header.size + len(payload)
+
+
+def recv_exactly(comm_socket, size: int):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = comm_socket.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return buffer
+
+
+# Returns the undecoded payload of the next message
+def recv_frame(comm_socket):
+    (size,) = header.unpack(recv_exactly(comm_socket, header.size))
+    if size > max_message_size:
+        raise ConnectionError(f"Message of {size} bytes exceeds the maximum size")
+    return recv_exactly(comm_socket, size)
+
+
+def recv_message(comm_socket):
+    return decode(recv_frame(comm_socket))
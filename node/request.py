@@ -1,99 +1,464 @@
-import pickle
+import bisect
+import collections
+import hashlib
+import os
 import random
 import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from node.metrics import Metrics
+from node.node import P2PNode
+from node.protocol import (RemoteError, decode, encode, header, recv_frame,
+                           send_message)
 
-def send_command(command: str, host: str, port: int):
-    # print(f"{host}:{port}: Sending message", flush=True)
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(2.0)
-    comm_socket.connect((host, port))
-    comm_socket.send(command.encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.send("close".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
-
-
-def send_command_async(command: str, host: str, port: int):
-    # print(f"{host}:{port}: Sending message", flush=True)
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(2.0)
-    comm_socket.connect((host, port))
-    comm_socket.send(command.encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
-
-
-def send_command_with_response(command: str, host: str, port: int):
-    # print(f"{host}:{port}: Sending message", flush=True)
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(5.0)
-    comm_socket.connect((host, port))
-    comm_socket.send(command.encode("utf-8"))
-    response = pickle.loads(comm_socket.recv(1024))
-    comm_socket.send("close".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
-    return response
+
+# Keeps idle connections to peers open so that consecutive commands to the same
+# node reuse them instead of paying a connect/close handshake every time
+class ConnectionPool:
+    def __init__(self, max_idle_per_peer=4, idle_timeout=30.0):
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle_timeout = idle_timeout
+        self.__idle = {}
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+
+    def acquire(self, host: str, port: int, timeout: float):
+        now = time.monotonic()
+        comm_socket = None
+        with self.__lock:
+            self.__check_fork()
+            idle = self.__idle.get((host, port), [])
+            while len(idle) > 0 and comm_socket is None:
+                candidate, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    comm_socket = candidate
+                else:
+                    candidate.close()
+        if comm_socket is not None:
+            comm_socket.settimeout(timeout)
+            return comm_socket, True
+        comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        comm_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        comm_socket.settimeout(timeout)
+        try:
+            comm_socket.connect((host, port))
+        except Exception:
+            comm_socket.close()
+            self.evict(host, port)
+            raise
+        return comm_socket, False
+
+    def release(self, host: str, port: int, comm_socket):
+        with self.__lock:
+            self.__check_fork()
+            idle = self.__idle.setdefault((host, port), [])
+            if len(idle) < self.max_idle_per_peer:
+                idle.append((comm_socket, time.monotonic()))
+                return
+        comm_socket.close()
+
+    # Closes every idle connection to a peer, used when the peer stops answering
+    def evict(self, host: str, port: int):
+        with self.__lock:
+            idle = self.__idle.pop((host, port), [])
+        for comm_socket, _ in idle:
+            comm_socket.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for comm_socket, _ in connections:
+                comm_socket.close()
+
+    # Connections inherited from a parent process belong to the parent
+    def __check_fork(self):
+        if self.__pid != os.getpid():
+            self.__idle = {}
+            self.__pid = os.getpid()
+
+
+connection_pool = ConnectionPool()
+# Latency and bytes of every request this process sends, by command
+client_metrics = Metrics()
+
+
+# Liveness of the peers this process talks to. Every answered request is a
+# sign of life, so a node only needs to send heartbeats over links that went
+# idle. Heartbeat round trips are smoothed like TCP does for its retransmission
+# timeout and a peer that doesn't answer a heartbeat within that timeout is
+# suspected. Shared by every node of the process
+class FailureDetector:
+    def __init__(self, min_timeout=0.5, max_timeout=5.0, clock=time.monotonic):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.clock = clock
+        self.__peers = {}  # (host, port) to [last heard, smoothed rtt, variation]
+        self.__lock = threading.Lock()
+
+    # A round trip time is only given for heartbeats, the other requests take
+    # as long as the work they carry
+    def heard(self, host: str, port: int, rtt=None):
+        now = self.clock()
+        with self.__lock:
+            peer = self.__peers.get((host, port))
+            if peer is None:
+                peer = self.__peers[(host, port)] = [now, None, None]
+            peer[0] = now
+            if rtt is None:
+                return
+            if peer[1] is None:
+                peer[1], peer[2] = rtt, rtt / 2
+            else:
+                peer[2] = 0.75 * peer[2] + 0.25 * abs(peer[1] - rtt)
+                peer[1] = 0.875 * peer[1] + 0.125 * rtt
+
+    # The peer didn't answer, whatever was heard of it before no longer counts
+    def failed(self, host: str, port: int):
+        with self.__lock:
+            peer = self.__peers.get((host, port))
+            if peer is not None:
+                peer[0] = None
+
+    # Whether nothing was heard of the peer for the last interval seconds
+    def idle(self, host: str, port: int, interval: float):
+        with self.__lock:
+            peer = self.__peers.get((host, port))
+            last_heard = peer[0] if peer is not None else None
+        return last_heard is None or self.clock() - last_heard >= interval
+
+    def clear(self):
+        with self.__lock:
+            self.__peers = {}
+
+    # How long to wait for a heartbeat before suspecting the peer
+    def timeout(self, host: str, port: int):
+        with self.__lock:
+            peer = self.__peers.get((host, port))
+            if peer is None or peer[1] is None:
+                return self.max_timeout
+            timeout = peer[1] + 4 * peer[2]
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+
+failure_detector = FailureDetector()
+
+
+# Carries requests to peers over pooled TCP connections
+class SocketTransport:
+    # Returns the bytes sent, the bytes received and the [ok, result] response
+    def exchange(self, host: str, port: int, timeout: float, request):
+        sent, frame = self.__exchange(host, port, timeout, request)
+        return sent, header.size + len(frame), decode(frame)
+
+    # Sends the request on a pooled connection, returns the bytes sent and the
+    # undecoded response
+    def __exchange(self, host: str, port: int, timeout: float, request):
+        comm_socket, reused = connection_pool.acquire(host, port, timeout)
+        try:
+            sent = send_message(comm_socket, request)
+            frame = recv_frame(comm_socket)
+        except ConnectionError:
+            comm_socket.close()
+            if not reused:
+                connection_pool.evict(host, port)
+                raise
+            # The pooled connection went stale, retry once on a fresh one
+            connection_pool.evict(host, port)
+            comm_socket, _ = connection_pool.acquire(host, port, timeout)
+            try:
+                sent = send_message(comm_socket, request)
+                frame = recv_frame(comm_socket)
+            except Exception:
+                comm_socket.close()
+                connection_pool.evict(host, port)
+                raise
+        except Exception:
+            comm_socket.close()
+            connection_pool.evict(host, port)
+            raise
+        connection_pool.release(host, port, comm_socket)
+        return sent, frame
+
+
+# Delivers a request by running it on the addressed node right away, on the
+# caller's thread. Requests and responses are only serialized if asked to,
+# which copies them like the network would and measures their size. Requests
+# to other addresses go to the fallback transport if there is one
+class MemoryTransport:
+    def __init__(self, serialize=False, fallback=None):
+        self.serialize = serialize
+        self.fallback = fallback
+        self.nodes = {}  # (host, port) to node
+        self.messages = collections.Counter()  # Requests delivered, by command
+        self.bytes = 0
+        self.counting = True
+
+    def exchange(self, host: str, port: int, timeout: float, request):
+        node = self.nodes.get((host, port))
+        if node is None:
+            if self.fallback is not None:
+                return self.fallback.exchange(host, port, timeout, request)
+            raise ConnectionRefusedError(f"No node at {host}:{port}")
+        sent = received = 0
+        if self.serialize:
+            payload = encode(request)
+            sent = header.size + len(payload)
+        start = time.perf_counter()
+        if self.serialize:
+            request = decode(payload)
+        if self.counting:
+            self.messages[request[0]] += 1
+        response = node.execute_request(request)
+        if request[0] in ("leave", "kill"):
+            self.nodes.pop((host, port), None)
+        if self.serialize:
+            payload = encode(response)
+            received = header.size + len(payload)
+        # The node records the requests it served like its server would
+        node.metrics.record_rpc(
+            request[0], time.perf_counter() - start, sent, received, response[0]
+        )
+        if self.serialize:
+            response = decode(payload)
+        if self.counting:
+            self.bytes += sent + received
+        return sent, received, response
+
+
+# Every request of this process goes through the transport, the simulator and
+# the node host replace it with one that calls their nodes in memory
+transport = SocketTransport()
+
+
+# Returns the transport that was replaced
+def set_transport(new_transport):
+    global transport
+    previous, transport = transport, new_transport
+    return previous
+
+
+def _request(host: str, port: int, timeout: float, request):
+    start = time.perf_counter()
+    try:
+        sent, received, (ok, result) = transport.exchange(
+            host, port, timeout, request
+        )
+    except Exception:
+        client_metrics.record_rpc(request[0], time.perf_counter() - start, 0, 0, False)
+        failure_detector.failed(host, port)
+        raise
+    elapsed = time.perf_counter() - start
+    client_metrics.record_rpc(request[0], elapsed, received, sent, ok)
+    failure_detector.heard(host, port, elapsed if request[0] == "heartbeat" else None)
+    if not ok:
+        raise RemoteError(result)
+    return result
+
+
+def send_command(command: str, host: str, port: int, *args):
+    _request(host, port, 2.0, [command, *args])
+
+
+def send_command_with_response(command: str, host: str, port: int, *args):
+    return _request(host, port, 5.0, [command, *args])
+
+
+# Returns the node's [predecessor, successor_list], within the timeout the
+# failure detector allows it
+def send_heartbeat_command(host: str, port: int):
+    return _request(host, port, failure_detector.timeout(host, port), ["heartbeat"])
 
 
 def send_store_command(host: str, port: int, chord_key: int, data_key: str, data):
-    # print(f"{host}:{port}: Sending message", flush=True)
     if data_key != "nan":
         data_key = str(float(data_key))
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(5.0)
-    comm_socket.connect((host, port))
-    comm_socket.send("store".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(chord_key))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(data_key))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(data))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall("close".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
-
-
-def send_transfer_receive_command(
+    _request(host, port, 5.0, ["store", chord_key, data_key, data])
+
+
+# Stores the value only if the node owns chord_key, returns whether it did
+def send_direct_store_command(
     host: str, port: int, chord_key: int, data_key: str, data
 ):
-    # print(f"{host}:{port}: Sending message", flush=True)
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(5.0)
-    comm_socket.connect((host, port))
-    comm_socket.send("transfer_receive".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(chord_key))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(data_key))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(data))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall("close".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
+    return _request(host, port, 5.0, ["direct_store", chord_key, data_key, data])
+
+
+def send_store_many_command(host: str, port: int, items, hops: int = 0):
+    items = [
+        [chord_key, str(float(data_key)) if data_key != "nan" else data_key, data]
+        for chord_key, data_key, data in items
+    ]
+    _request(host, port, 60.0, ["store_many", items, hops])
+
+
+# Splits items into store_many batches and sends them to the entry nodes
+# round robin, several batches at a time
+def bulk_store(
+    entry_nodes, items, batch_size: int = 500, parallelism: int = 8, progress=None
+):
+    batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = []
+        for i, batch in enumerate(batches):
+            host, port = entry_nodes[i % len(entry_nodes)]
+            futures.append(executor.submit(send_store_many_command, host, port, batch))
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress is not None:
+                progress(done, len(batches))
 
 
 def send_lookup_command(host: str, port: int, chord_key: int, data_key: str):
-    # print(f"{host}:{port}: Sending message", flush=True)
     if data_key != "nan":
         data_key = str(float(data_key))
-    comm_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    comm_socket.settimeout(15.0)
-    comm_socket.connect((host, port))
-    comm_socket.send("lookup".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(chord_key))
-    _ = comm_socket.recv(1024)
-    comm_socket.sendall(pickle.dumps(data_key))
-    _ = comm_socket.recv(1024)
-    result = pickle.loads(comm_socket.recv(10240))
-    comm_socket.sendall("close".encode("utf-8"))
-    _ = comm_socket.recv(1024)
-    comm_socket.close()
-    return result
+    return _request(host, port, 15.0, ["lookup", chord_key, data_key])
+
+
+# Returns the values in [offset, offset + limit)
+def send_lookup_page_command(
+    host: str, port: int, chord_key: int, data_key: str, offset: int, limit: int
+):
+    if data_key != "nan":
+        data_key = str(float(data_key))
+    return _request(
+        host, port, 15.0, ["lookup_page", chord_key, data_key, offset, limit]
+    )
+
+
+# Yields the values one page at a time, so a huge value list is never held
+# whole by either side
+def iter_lookup(
+    host: str, port: int, chord_key: int, data_key: str, page_size: int = 1000
+):
+    offset = 0
+    while True:
+        values = send_lookup_page_command(
+            host, port, chord_key, data_key, offset, page_size
+        )
+        yield from values
+        if len(values) < page_size or values == ["Not Found"]:
+            return
+        offset += page_size
+
+
+# Returns [data_key, values] pairs for the award counts in [low, high] in
+# ascending order, None leaves a side of the range open. offset and limit page
+# over the pairs
+def send_lookup_range_command(
+    host: str,
+    port: int,
+    chord_key: int,
+    low: float = None,
+    high: float = None,
+    offset: int = 0,
+    limit: int = None,
+):
+    return _request(
+        host, port, 15.0, ["lookup_range", chord_key, low, high, offset, limit]
+    )
+
+
+def send_lookup_all_command(
+    host: str, port: int, chord_key: int, offset: int = 0, limit: int = None
+):
+    return _request(host, port, 15.0, ["lookup_all", chord_key, offset, limit])
+
+
+# A query is either a data key or a [low, high] range of data keys and a page
+# an [offset, limit] slice of the result.
+# Returns [owned, values], values are only looked up if the node owns chord_key
+# or, with replica set, holds a replica of it
+# The sender may cache hot values the owner leases to it
+def send_direct_lookup_command(
+    host: str,
+    port: int,
+    chord_key: int,
+    query,
+    replica: bool = False,
+    page=None,
+    sender=None,
+):
+    return _request(
+        host, port, 5.0, ["direct_lookup", chord_key, query, replica, page, sender]
+    )
+
+
+def send_forward_lookup_command(
+    host: str,
+    port: int,
+    chord_key: int,
+    query,
+    request_id: str,
+    hops: int,
+    page=None,
+    sender=None,
+):
+    return _request(
+        host,
+        port,
+        15.0,
+        ["forward_lookup", chord_key, query, request_id, hops, page, sender],
+    )
+
+
+def send_lookup_many_command(host: str, port: int, keys, hops: int = 0):
+    keys = [
+        [chord_key, str(float(data_key)) if data_key != "nan" else data_key]
+        for chord_key, data_key in keys
+    ]
+    return _request(host, port, 60.0, ["lookup_many", keys, hops])
+
+
+def _node_id(host: str, port: int):
+    return int(hashlib.md5((host + str(port)).encode()).hexdigest(), 16)
+
+
+# True once the predecessor and successor list of every node match the ring
+# formed by the given (host, port) addresses and every node knows its fingers
+def ring_converged(nodes, size_successor_list: int):
+    ring = sorted((_node_id(host, port), host, port) for host, port in nodes)
+    ids = [id for id, _, _ in ring]
+
+    def successor_of(id):
+        return ids[bisect.bisect_left(ids, id) % len(ids)]
+
+    for i, (id, host, port) in enumerate(ring):
+        try:
+            predecessor, successor_list, finger_nodes = send_command_with_response(
+                "get_routing_state", host, port
+            )
+        except Exception:
+            return False
+        if len(ring) == 1:
+            continue
+        if predecessor.id != ids[i - 1]:
+            return False
+        expected = [ids[(i + j) % len(ids)] for j in range(1, len(ids))]
+        expected = expected[:size_successor_list]
+        if [node.id for node in successor_list[: len(expected)]] != expected:
+            return False
+        fingers = {
+            successor_of((id + 2**j) % P2PNode.hash_max_num)
+            for j in range(P2PNode.hash_size)
+        }
+        fingers.discard(id)
+        # Extra nodes may be known as well. Departed ones among them are only
+        # dropped once a route through them fails, so they don't count
+        if not fingers <= {node.id for node in finger_nodes}:
+            return False
+    return True
+
+
+# Polls the ring until it converged and returns the seconds it took, or None
+# after timeout seconds
+def wait_for_convergence(
+    nodes, size_successor_list: int, timeout: float = 60.0, poll_interval=0.05
+):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if ring_converged(nodes, size_successor_list):
+            return time.monotonic() - start
+        time.sleep(poll_interval)
+    return None
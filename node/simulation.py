@@ -0,0 +1,137 @@
+import bisect
+import heapq
+import itertools
+import random
+
+from node.chord import ChordNode
+from node.request import (MemoryTransport, failure_detector, ring_converged,
+                          send_command, send_command_with_response,
+                          set_transport)
+
+
+# Runs ChordNodes in this process on a virtual clock. Each node's stabilize,
+# fix_fingers and heartbeat rounds are events repeating at their intervals,
+# and time only advances from one event to the next, so rings of thousands of
+# nodes run on a single core and every message is counted.
+# Use it as a context manager, requests of the process go to the simulated
+# nodes while it is open and the failure detector runs on the virtual clock.
+# The settings are shared by every node and switched to the simulator's clock
+class Simulator:
+    def __init__(self, settings, seed=0, serialize=False, host="sim"):
+        settings.maintenance_threads = False
+        settings.clock = self.clock
+        self.settings = settings
+        self.host = host
+        self.now = 0.0
+        self.random = random.Random(seed)
+        self.transport = MemoryTransport(serialize)
+        self.nodes = {}  # port to node
+        self.__ring = []  # Sorted ids of the nodes
+        self.__node_by_id = {}
+        self.__ports = []
+        self.__next_port = 1
+        self.__events = []
+        self.__sequence = itertools.count()
+        self.__previous_transport = None
+        self.__previous_clock = None
+
+    def __enter__(self):
+        self.__previous_transport = set_transport(self.transport)
+        self.__previous_clock = failure_detector.clock
+        failure_detector.clock = self.clock
+        failure_detector.clear()
+        return self
+
+    def __exit__(self, *exc_info):
+        set_transport(self.__previous_transport)
+        failure_detector.clock = self.__previous_clock
+        failure_detector.clear()
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, delay, callback):
+        heapq.heappush(
+            self.__events, (self.now + delay, next(self.__sequence), callback)
+        )
+
+    # Runs the events of the next duration seconds
+    def run(self, duration):
+        end = self.now + duration
+        while len(self.__events) > 0 and self.__events[0][0] <= end:
+            self.now, _, callback = heapq.heappop(self.__events)
+            callback()
+        self.now = end
+
+    # Joins a new node through a random node and returns its port. Settling
+    # stabilizes the node and its predecessor at once, as if the ring had time
+    # to stabilize between joins, so large rings are built without simulating
+    # those rounds
+    def add_node(self, settle=True):
+        port = self.__next_port
+        self.__next_port += 1
+        node = ChordNode(self.host, port, self.settings)
+        self.transport.nodes[(self.host, port)] = node
+        if len(self.nodes) == 0:
+            send_command("initialize_network", self.host, port)
+        else:
+            send_command_with_response(
+                "join", self.host, port, self.host, self.random_node()
+            )
+        if settle and len(self.nodes) > 0:
+            node.stabilize_round()
+            index = bisect.bisect_left(self.__ring, node.id) - 1
+            predecessor = self.__ring[index]
+            self.__node_by_id[predecessor].stabilize_round()
+        self.nodes[port] = node
+        bisect.insort(self.__ring, node.id)
+        self.__node_by_id[node.id] = node
+        self.__ports.append(port)
+        for interval, maintenance_round in (
+            (self.settings.stabilize_interval, node.stabilize_round),
+            (self.settings.fix_fingers_interval, node.fix_fingers_round),
+            (self.settings.ping_successors_interval, node.heartbeat_round),
+        ):
+            # Random phases keep the nodes from running their rounds in lockstep
+            self.__repeat(
+                port, node, interval, maintenance_round, self.random.random()
+            )
+        return port
+
+    # The node leaves gracefully or, when killed, just stops answering
+    def remove_node(self, port, kill=False):
+        send_command_with_response("kill" if kill else "leave", self.host, port)
+        node = self.nodes.pop(port)
+        self.__ring.remove(node.id)
+        del self.__node_by_id[node.id]
+        self.__ports.remove(port)
+
+    def random_node(self):
+        return self.random.choice(self.__ports)
+
+    def addresses(self):
+        return [(self.host, port) for port in self.nodes]
+
+    # Checks the routing state of every node without counting the requests
+    def converged(self):
+        self.transport.counting = False
+        try:
+            return ring_converged(self.addresses(), self.settings.size_successor_list)
+        finally:
+            self.transport.counting = True
+
+    def messages(self, reset=False):
+        messages = dict(self.transport.messages)
+        if reset:
+            self.transport.messages.clear()
+            self.transport.bytes = 0
+        return messages
+
+    def __repeat(self, port, node, interval, maintenance_round, phase=1.0):
+        def run():
+            # Rounds of removed nodes stop with them
+            if self.nodes.get(port) is node:
+                maintenance_round()
+                self.schedule(interval, run)
+
+        self.schedule(interval * phase, run)
@@ -0,0 +1,417 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+import msgpack
+
+
+# In memory storage engine that keeps chord keys sorted, so the keys of a ring
+# interval are found with two bisects instead of a scan over every stored key.
+# The numeric data keys of every chord key are kept sorted as well, for range
+# queries over them
+class SortedStorage:
+    def __init__(self):
+        self.__keys = []
+        self.__entries = {}
+        self.__indexes = {}
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def store(self, chord_key, data_key, data):
+        entries = self.__entries.get(chord_key)
+        if entries is None:
+            bisect.insort(self.__keys, chord_key)
+            entries = self.__entries[chord_key] = {}
+        if data_key not in entries:
+            self.__index(chord_key, data_key)
+        entries.setdefault(data_key, []).append(data)
+
+    # Only the values in [offset, offset + limit) are copied, a limit of None
+    # reads to the end
+    def get(self, chord_key, data_key, offset=0, limit=None):
+        entries = self.__entries.get(chord_key)
+        if entries is None or data_key not in entries:
+            return None
+        return entries[data_key][offset : _stop(offset, limit)]
+
+    # Returns [data_key, values] pairs of the numeric data keys in [low, high]
+    # in ascending order, None leaves a side open. Without any bound every data
+    # key is returned, the non numeric ones last. offset and limit page over
+    # the pairs
+    def get_range(self, chord_key, low=None, high=None, offset=0, limit=None):
+        entries = self.__entries.get(chord_key)
+        if entries is None:
+            return []
+        index = self.__indexes.get(chord_key, [])
+        start = 0
+        if low is not None:
+            start = bisect.bisect_left(index, low, key=lambda entry: entry[0])
+        end = len(index)
+        if high is not None:
+            end = bisect.bisect_right(index, high, key=lambda entry: entry[0])
+        data_keys = [data_key for _, data_key in index[start:end]]
+        if low is None and high is None and len(index) < len(entries):
+            data_keys += [
+                data_key for data_key in entries if _number(data_key) is None
+            ]
+        return [
+            [data_key, list(entries[data_key])]
+            for data_key in data_keys[offset : _stop(offset, limit)]
+        ]
+
+    # Adds every value of a {chord_key: {data_key: [values]}} batch
+    def merge(self, data):
+        for chord_key, entries in data.items():
+            stored = self.__entries.get(chord_key)
+            if stored is None:
+                bisect.insort(self.__keys, chord_key)
+                stored = self.__entries[chord_key] = {}
+            for data_key, values in entries.items():
+                if data_key not in stored:
+                    self.__index(chord_key, data_key)
+                stored.setdefault(data_key, []).extend(values)
+
+    # Removes and returns the keys in the circular interval [start, end)
+    def pop_range(self, start, end):
+        low = bisect.bisect_left(self.__keys, start)
+        high = bisect.bisect_left(self.__keys, end)
+        if start < end:
+            slices = [(low, high)]
+        elif start > end:
+            slices = [(low, len(self.__keys)), (0, high)]
+        else:
+            slices = [(0, len(self.__keys))]
+        data = {}
+        for low, high in slices:
+            for chord_key in self.__keys[low:high]:
+                data[chord_key] = self.__entries.pop(chord_key)
+                self.__indexes.pop(chord_key, None)
+        for low, high in slices:
+            del self.__keys[low:high]
+        return data
+
+    def pop_all(self):
+        data = self.__entries
+        self.__keys = []
+        self.__entries = {}
+        self.__indexes = {}
+        return data
+
+    def items(self):
+        for chord_key in self.__keys:
+            yield chord_key, self.__entries[chord_key]
+
+    # Every (chord_key, data_key) pair, without the values
+    def keys(self):
+        for chord_key in self.__keys:
+            for data_key in self.__entries[chord_key]:
+                yield chord_key, data_key
+
+    def __index(self, chord_key, data_key):
+        number = _number(data_key)
+        if number is not None:
+            bisect.insort(self.__indexes.setdefault(chord_key, []), (number, data_key))
+
+
+# Bloom filter over (chord_key, data_key) pairs, a negative answer means the
+# pair was never added. Filters with the same number of bits and hashes are
+# combined by or-ing their bits
+class BloomFilter:
+    def __init__(self, num_bits=2**20, num_hashes=7):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+
+    def add(self, chord_key, data_key):
+        for position in self.__positions(chord_key, data_key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, pairs):
+        for chord_key, data_key in pairs:
+            self.add(chord_key, data_key)
+
+    def might_contain(self, chord_key, data_key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.__positions(chord_key, data_key)
+        )
+
+    def union(self, bits):
+        if len(bits) != len(self.bits):
+            raise ValueError("Can't combine filters of different sizes")
+        combined = int.from_bytes(self.bits, "big") | int.from_bytes(bits, "big")
+        self.bits = bytearray(combined.to_bytes(len(self.bits), "big"))
+
+    # Double hashing, every position derives from the same 128 bit digest
+    def __positions(self, chord_key, data_key):
+        digest = hashlib.blake2b(
+            f"{chord_key}:{data_key}".encode(), digest_size=16
+        ).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+
+class _Ref:
+    __slots__ = ("offset", "length")
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+
+
+# Durable storage engine. Every change is appended to a log and the whole data
+# set is periodically compacted into a snapshot that is memory mapped for
+# reads, so a restarted node only loads the snapshot index and replays the log
+# written since. Values must be plain msgpack types
+class LogStorage:
+    record_header = struct.Struct(">II")
+    snapshot_magic = b"CHS1"
+    snapshot_header = struct.Struct(">4sQ")
+    snapshot_footer = struct.Struct(">Q")
+
+    def __init__(self, directory, compact_bytes=4 * 1024 * 1024, sync=False):
+        self.directory = directory
+        self.compact_bytes = compact_bytes
+        self.sync = sync
+        self.__index = SortedStorage()
+        self.__snapshot = None
+        self.__snapshot_file = None
+        self.__snapshot_size = 0
+        self.__generation = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__load_snapshot()
+        self.__replay_log()
+        for name in os.listdir(directory):
+            if name.startswith("log.") and name != f"log.{self.__generation}":
+                os.remove(os.path.join(directory, name))
+        self.__log = open(self.__log_path(self.__generation), "ab", buffering=0)
+        self.__log_size = self.__log.tell()
+
+    def __len__(self):
+        return len(self.__index)
+
+    def store(self, chord_key, data_key, data):
+        self.__append([("s", _key_bytes(chord_key), data_key)], [_pack(data)])
+        self.__index.store(chord_key, data_key, data)
+        self.__maybe_compact()
+
+    def get(self, chord_key, data_key, offset=0, limit=None):
+        values = self.__index.get(chord_key, data_key, offset, limit)
+        if values is None:
+            return None
+        return [self.__resolve(value) for value in values]
+
+    def merge(self, data):
+        records = []
+        values = []
+        for chord_key, entries in data.items():
+            for data_key, entry_values in entries.items():
+                for value in entry_values:
+                    records.append(("s", _key_bytes(chord_key), data_key))
+                    values.append(_pack(value))
+        self.__append(records, values)
+        self.__index.merge(data)
+        self.__maybe_compact()
+
+    def pop_range(self, start, end):
+        data = self.__index.pop_range(start, end)
+        if len(data) > 0:
+            self.__append([("p", _key_bytes(start), _key_bytes(end))], [b""])
+        return self.__resolve_all(data)
+
+    def pop_all(self):
+        data = self.__index.pop_all()
+        if len(data) > 0:
+            self.__append([("a",)], [b""])
+        return self.__resolve_all(data)
+
+    def get_range(self, chord_key, low=None, high=None, offset=0, limit=None):
+        return [
+            [data_key, [self.__resolve(value) for value in values]]
+            for data_key, values in self.__index.get_range(
+                chord_key, low, high, offset, limit
+            )
+        ]
+
+    def items(self):
+        for chord_key, entries in self.__index.items():
+            yield chord_key, {
+                data_key: [self.__resolve(value) for value in values]
+                for data_key, values in entries.items()
+            }
+
+    def keys(self):
+        return self.__index.keys()
+
+    # Writes every entry into a new snapshot and starts an empty log. Values
+    # that already live in the old snapshot are copied without decoding them
+    def compact(self):
+        generation = self.__generation + 1
+        temporary_path = os.path.join(self.directory, "snapshot.tmp")
+        index = []
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(
+                self.snapshot_header.pack(self.snapshot_magic, generation)
+            )
+            offset = self.snapshot_header.size
+            compacted = SortedStorage()
+            for chord_key, entries in self.__index.items():
+                for data_key, values in entries.items():
+                    refs = []
+                    for value in values:
+                        if isinstance(value, _Ref):
+                            packed = self.__snapshot[
+                                value.offset : value.offset + value.length
+                            ]
+                        else:
+                            packed = _pack(value)
+                        snapshot_file.write(packed)
+                        refs.append(_Ref(offset, len(packed)))
+                        offset += len(packed)
+                    locations = [[ref.offset, ref.length] for ref in refs]
+                    index.append([_key_bytes(chord_key), data_key, locations])
+                    compacted.merge({chord_key: {data_key: refs}})
+            snapshot_file.write(msgpack.packb(index, use_bin_type=True))
+            snapshot_file.write(self.snapshot_footer.pack(offset))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, os.path.join(self.directory, "snapshot"))
+        self.__log.close()
+        os.remove(self.__log_path(self.__generation))
+        self.__generation = generation
+        self.__log = open(self.__log_path(generation), "ab", buffering=0)
+        self.__log_size = 0
+        self.__close_snapshot()
+        self.__open_snapshot()
+        self.__index = compacted
+
+    def close(self):
+        self.__log.close()
+        self.__close_snapshot()
+
+    def __log_path(self, generation):
+        return os.path.join(self.directory, f"log.{generation}")
+
+    def __append(self, records, values):
+        if len(records) == 0:
+            return
+        buffer = bytearray()
+        for record, value in zip(records, values):
+            meta = msgpack.packb(record, use_bin_type=True)
+            buffer += self.record_header.pack(len(meta), len(value))
+            buffer += meta
+            buffer += value
+        self.__log.write(buffer)
+        if self.sync:
+            os.fsync(self.__log.fileno())
+        self.__log_size += len(buffer)
+
+    # Compacting once the log outgrows the snapshot keeps every value rewritten
+    # only a bounded number of times
+    def __maybe_compact(self):
+        if self.__log_size >= max(self.compact_bytes, self.__snapshot_size):
+            self.compact()
+
+    def __resolve(self, value):
+        if isinstance(value, _Ref):
+            packed = self.__snapshot[value.offset : value.offset + value.length]
+            return msgpack.unpackb(packed, raw=False)
+        return value
+
+    def __resolve_all(self, data):
+        return {
+            chord_key: {
+                data_key: [self.__resolve(value) for value in values]
+                for data_key, values in entries.items()
+            }
+            for chord_key, entries in data.items()
+        }
+
+    def __open_snapshot(self):
+        path = os.path.join(self.directory, "snapshot")
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return False
+        self.__snapshot_file = open(path, "rb")
+        self.__snapshot = mmap.mmap(
+            self.__snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+        self.__snapshot_size = len(self.__snapshot)
+        return True
+
+    def __close_snapshot(self):
+        if self.__snapshot is not None:
+            self.__snapshot.close()
+            self.__snapshot_file.close()
+        self.__snapshot = None
+        self.__snapshot_file = None
+        self.__snapshot_size = 0
+
+    def __load_snapshot(self):
+        if not self.__open_snapshot():
+            return
+        magic, self.__generation = self.snapshot_header.unpack_from(self.__snapshot, 0)
+        if magic != self.snapshot_magic:
+            raise ValueError(f"{self.directory} doesn't contain a valid snapshot")
+        index_end = self.__snapshot_size - self.snapshot_footer.size
+        (index_offset,) = self.snapshot_footer.unpack_from(self.__snapshot, index_end)
+        index = msgpack.unpackb(self.__snapshot[index_offset:index_end], raw=False)
+        for key, data_key, locations in index:
+            refs = [_Ref(offset, length) for offset, length in locations]
+            self.__index.merge({_key_int(key): {data_key: refs}})
+
+    def __replay_log(self):
+        path = self.__log_path(self.__generation)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as log_file:
+            log = log_file.read()
+        position = 0
+        while position + self.record_header.size <= len(log):
+            meta_length, value_length = self.record_header.unpack_from(log, position)
+            end = position + self.record_header.size + meta_length + value_length
+            if end > len(log):
+                break  # Torn write at the end of the log
+            value_start = position + self.record_header.size + meta_length
+            record = msgpack.unpackb(log[value_start - meta_length : value_start], raw=False)
+            if record[0] == "s":
+                value = msgpack.unpackb(log[value_start:end], raw=False)
+                self.__index.store(_key_int(record[1]), record[2], value)
+            elif record[0] == "p":
+                self.__index.pop_range(_key_int(record[1]), _key_int(record[2]))
+            elif record[0] == "a":
+                self.__index.pop_all()
+            position = end
+        if position < len(log):
+            with open(path, "r+b") as log_file:
+                log_file.truncate(position)
+
+
+def _key_bytes(key):
+    return key.to_bytes(max(1, (key.bit_length() + 7) // 8), "big")
+
+
+def _key_int(key):
+    return int.from_bytes(key, "big")
+
+
+def _pack(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _stop(offset, limit):
+    return None if limit is None else offset + limit
+
+
+# Award counts are stored as str(float(...)) and "nan" when missing
+def _number(data_key):
+    try:
+        number = float(data_key)
+    except (TypeError, ValueError):
+        return None
+    if number != number:
+        return None
+    return number
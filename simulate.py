@@ -0,0 +1,136 @@
+import argparse
+import hashlib
+import json
+import time
+
+from node.chord import ChordNodeSettings
+from node.request import send_lookup_command, send_store_command
+from node.simulation import Simulator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Simulates a Chord ring in this process on a virtual clock"
+    )
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1000])
+    parser.add_argument("--successors", type=int, default=5)
+    parser.add_argument("--stabilize", type=float, default=0.5)
+    parser.add_argument("--fix-fingers", type=float, default=0.3)
+    parser.add_argument("--ping", type=float, default=0.2)
+    parser.add_argument("--replication", type=int, default=1)
+    parser.add_argument("--warmup", type=float, default=0.0, help="virtual seconds")
+    parser.add_argument("--ops", type=int, default=1000, help="stores and lookups")
+    parser.add_argument("--churn-events", type=int, default=0)
+    parser.add_argument(
+        "--churn-interval", type=float, default=1.0, help="virtual seconds"
+    )
+    parser.add_argument(
+        "--kill", action="store_true", help="churn kills nodes instead of leaving"
+    )
+    parser.add_argument(
+        "--serialize", action="store_true", help="encode messages to count bytes"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    return parser.parse_args()
+
+
+def lookup_items(sim, items):
+    found = 0
+    for key, data_key, value in items:
+        host, port = sim.host, sim.random_node()
+        found += value in send_lookup_command(host, port, key, data_key)
+    return found
+
+
+def run(args, num_nodes):
+    settings = ChordNodeSettings(
+        args.successors,
+        args.stabilize,
+        args.fix_fingers,
+        args.ping,
+        replication_factor=args.replication,
+    )
+    results = []
+    with Simulator(settings, args.seed, args.serialize) as sim:
+
+        def result(scenario, start, ops=None, **fields):
+            sent = sim.transport.bytes if args.serialize else None
+            messages = sim.messages(reset=True)
+            total = sum(messages.values())
+            results.append(
+                {"scenario": scenario}
+                | fields
+                | {
+                    "virtual_time_s": sim.now,
+                    "wall_time_s": time.perf_counter() - start,
+                    "messages": total,
+                    "messages_per_op": total / ops if ops else None,
+                    "bytes": sent,
+                    "messages_by_command": messages,
+                }
+            )
+
+        start = time.perf_counter()
+        for _ in range(num_nodes):
+            sim.add_node()
+        result("build", start, num_nodes)
+        if args.warmup > 0:
+            start = time.perf_counter()
+            sim.run(args.warmup)
+            result("warmup", start, converged=sim.converged())
+        items = [
+            [
+                int(hashlib.md5(f"key {i}".encode()).hexdigest(), 16),
+                str(i % 50),
+                f"value {i}",
+            ]
+            for i in range(args.ops)
+        ]
+        start = time.perf_counter()
+        for key, data_key, value in items:
+            send_store_command(sim.host, sim.random_node(), key, data_key, value)
+        result("store", start, len(items))
+        start = time.perf_counter()
+        found = lookup_items(sim, items)
+        result("lookup", start, len(items), success_rate=found / max(1, len(items)))
+        if args.churn_events > 0:
+            start = time.perf_counter()
+            for _ in range(args.churn_events):
+                sim.remove_node(sim.random_node(), args.kill)
+                sim.add_node(settle=False)
+                sim.run(args.churn_interval)
+            result("churn", start, args.churn_events, converged=sim.converged())
+            start = time.perf_counter()
+            found = lookup_items(sim, items)
+            result(
+                "lookup_after_churn",
+                start,
+                len(items),
+                success_rate=found / max(1, len(items)),
+            )
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    output = open(args.output, "a") if args.output else None
+    for num_nodes in args.nodes:
+        for result in run(args, num_nodes):
+            line = json.dumps(
+                {
+                    "nodes": num_nodes,
+                    "successors": args.successors,
+                    "stabilize": args.stabilize,
+                    "fix_fingers": args.fix_fingers,
+                    "ping": args.ping,
+                    "replication": args.replication,
+                    "seed": args.seed,
+                }
+                | result
+            )
+            print(line, flush=True)
+            if output is not None:
+                output.write(line + "\n")
+    if output is not None:
+        output.close()
@@ -0,0 +1,50 @@
+import unittest
+
+from node.chord import ChordNodeSettings
+from node.request import send_lookup_command, send_store_command
+from node.simulation import Simulator
+
+
+class HotKeyLeaseTest(unittest.TestCase):
+    # A store landing right after the owner read the values of a hot key must
+    # not leave the old values leased to the node that asked for them
+    def test_store_between_read_and_lease(self):
+        settings = ChordNodeSettings(5, 0.5, 0.3, 0.2, hot_key_threshold=1)
+        with Simulator(settings, seed=1) as sim:
+            for _ in range(8):
+                sim.add_node()
+            sim.run(5.0)
+            chord_key, data_key = 12345, "1.0"
+            send_store_command(sim.host, sim.random_node(), chord_key, data_key, "a")
+            owner = next(
+                node
+                for node in sim.nodes.values()
+                if node.get_data(chord_key, data_key) == ["a"]
+            )
+            entry = next(port for port in sim.nodes if port != owner.port)
+            # Teaches the entry node the owner, so its next read asks the owner
+            # directly and is leased the values
+            send_lookup_command(sim.host, entry, chord_key, data_key)
+            query_data = owner._ChordNode__query_data
+            writes = ["b"]
+
+            def query_then_store(*args, **kwargs):
+                values = query_data(*args, **kwargs)
+                if len(writes) > 0:
+                    send_store_command(
+                        owner.host, owner.port, chord_key, data_key, writes.pop()
+                    )
+                return values
+
+            owner._ChordNode__query_data = query_then_store
+            send_lookup_command(sim.host, entry, chord_key, data_key)
+            self.assertEqual(writes, [])
+            for _ in range(5):
+                self.assertEqual(
+                    send_lookup_command(sim.host, entry, chord_key, data_key),
+                    ["a", "b"],
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()